@@ -0,0 +1,190 @@
+import torch
+
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import resource
+import time
+
+import numpy as np
+
+from models.encoder import ConvEncoder
+from models.latentmodel import ConditionalQueryFNP
+
+
+def model_args(args, decoder, n_harmonics):
+    # the training defaults of main.py with the swept harmonics, lower_bound 1 and skip_step 1
+    return argparse.Namespace(decoder=decoder, n_harmonics=n_harmonics, lower_bound=1, upper_bound=n_harmonics, skip_step=1,
+                              NP=False, latent_dimension=args.latent_dimension, num_label=args.num_label,
+                              encoder_hidden_dim=32, encoder_blocks=3, decoder_layers=2, decoder_hidden_dim=256,
+                              dropout=0.1, dataset_type='sin', device=args.device)
+
+
+def synthetic_batch(B, S, N, num_label, device):
+    # labeled sums of random sinusoids on a shared grid, with sorted random observation indices
+    orig_ts = torch.linspace(0, 1, S)
+    label = torch.randint(0, num_label, (B,))
+    freqs = torch.randint(1, 10, (B, 3)).float()
+    phases = torch.rand(B, 3) * 2 * math.pi
+    sin = torch.sin(2 * math.pi * freqs.unsqueeze(1) * orig_ts.view(1, S, 1) + phases.unsqueeze(1)).sum(-1, keepdim=True)  # (B, S, 1)
+    index = torch.rand(B, S).argsort(dim=-1)[:, :N].sort(dim=-1)[0]  # (B, N)
+    return orig_ts.to(device), sin.to(device), label.to(device), index.to(device)
+
+
+def current_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def run_case(args, case):
+    # times one (component, mode, H, S, N, B) case, returns throughput, latency percentiles and peak memory
+    component, mode, H, S, N, B = case
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    margs = model_args(args, 'Fourier' if component == 'Encoder' else component, H)
+    orig_ts, sin, label, index = synthetic_batch(B, S, N, args.num_label, device)
+    t = orig_ts.expand(B, S)
+
+    if component == 'Encoder':
+        model = ConvEncoder(margs).to(device)
+        label_embed = torch.nn.functional.one_hot(label, args.num_label).float()
+        obs_x, obs_t = torch.gather(sin, 1, index.unsqueeze(-1)), torch.gather(t, 1, index)
+        step = lambda: model(obs_x, label_embed, obs_t)[1]
+    else:
+        model = ConditionalQueryFNP(margs).to(device)
+        z = torch.randn(B, args.latent_dimension + args.num_label, device=device, requires_grad=mode == 'fwd+bwd')
+        grid = orig_ts.unsqueeze(-1)
+        step = lambda: model.decode(t, z, sin, index, grid)
+
+    def iteration():
+        if mode == 'fwd':
+            with torch.no_grad():
+                step()
+        else:
+            step().pow(2).mean().backward()
+            model.zero_grad(set_to_none=True)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    model.train(mode == 'fwd+bwd')
+    # on CPU the RSS reference is taken before warmup, afterwards the allocator already holds the working set
+    start_memory = current_rss() if device.type == 'cpu' else 0
+    for _ in range(args.warmup):
+        iteration()
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        start_memory = torch.cuda.memory_allocated()
+
+    latencies = []
+    for _ in range(args.iters):
+        starttime = time.perf_counter()
+        iteration()
+        latencies.append(time.perf_counter() - starttime)
+
+    if device.type == 'cuda':
+        peak_memory = torch.cuda.max_memory_allocated() - start_memory
+    else:
+        # ru_maxrss is the high-water mark of this (isolated) process in KB
+        peak_memory = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - start_memory, 0)
+
+    latencies = np.array(latencies)
+    return {'component': component, 'mode': mode, 'n_harmonics': H, 'seq_len': S, 'n_obs': N, 'batch_size': B,
+            'samples_per_sec': B / latencies.mean(),
+            'latency_p50_ms': np.percentile(latencies, 50) * 1e3,
+            'latency_p90_ms': np.percentile(latencies, 90) * 1e3,
+            'latency_p99_ms': np.percentile(latencies, 99) * 1e3,
+            'peak_memory_mb': peak_memory / 2**20}
+
+
+def case_name(result):
+    return f"{result['component']}|{result['mode']}|H={result['n_harmonics']}|S={result['seq_len']}|N={result['n_obs']}|B={result['batch_size']}"
+
+
+def make_cases(args):
+    cases = []
+    for component, mode, H, S, N, B in itertools.product(args.components, args.modes, args.n_harmonics, args.seq_lens, args.n_obs, args.batch_sizes):
+        # only the Fourier decoder depends on the number of harmonics
+        if component != 'Fourier' and H != args.n_harmonics[0]:
+            continue
+        if N > S:
+            continue
+        cases.append((component, mode, H, S, N, B))
+    return cases
+
+
+def compare(results, baseline, threshold):
+    # a case regresses when its throughput falls more than threshold below the stored baseline
+    baseline = {case_name(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        name = case_name(result)
+        if name not in baseline:
+            continue
+        ratio = result['samples_per_sec'] / baseline[name]['samples_per_sec']
+        result['baseline_ratio'] = ratio
+        if ratio < 1 - threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='throughput / latency / memory benchmark of the encoder and every decoder')
+    parser.add_argument('--components', nargs='+', default=['Encoder', 'Fourier', 'NP', 'ODE', 'Transformer', 'RNN'],
+                        choices=['Encoder', 'Fourier', 'NP', 'ODE', 'Transformer', 'RNN'])
+    parser.add_argument('--modes', nargs='+', default=['fwd', 'fwd+bwd'], choices=['fwd', 'fwd+bwd'])
+    parser.add_argument('--n_harmonics', nargs='+', type=int, default=[4, 64])
+    parser.add_argument('--seq_lens', nargs='+', type=int, default=[500])
+    parser.add_argument('--n_obs', nargs='+', type=int, default=[100, 500])
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[64, 512])
+    parser.add_argument('--latent_dimension', type=int, default=3)
+    parser.add_argument('--num_label', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--output', type=str, default='benchmark_results.json')
+    parser.add_argument('--baseline', type=str, default=None, help='results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative throughput drop reported as a regression')
+    parser.add_argument('--no_isolate', action='store_true', help='run every case in this process, CPU peak memory is then not per case')
+    args = parser.parse_args()
+
+    # every CPU case runs in a fresh process so its peak RSS is its own
+    isolate = torch.device(args.device).type == 'cpu' and not args.no_isolate
+    context = multiprocessing.get_context('spawn')
+
+    results = []
+    for case in make_cases(args):
+        if isolate:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_case, (args, case))
+        else:
+            result = run_case(args, case)
+        results.append(result)
+        print(f"{case_name(result):<50} {result['samples_per_sec']:>12.1f} samples/s   p50 {result['latency_p50_ms']:.2f} ms   "
+              f"p99 {result['latency_p99_ms']:.2f} ms   peak {result['peak_memory_mb']:.1f} MB")
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.threshold)
+        for name, ratio in regressions:
+            print(f'[Regression] {name}: {ratio:.2f}x baseline throughput')
+
+    with open(args.output, 'w') as f:
+        json.dump({'device': args.device, 'num_threads': torch.get_num_threads() if args.num_threads is None else args.num_threads,
+                   'torch': torch.__version__, 'results': results}, f, indent=2)
+    print(f'Results saved at {args.output}')
+
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
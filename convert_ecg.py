@@ -0,0 +1,85 @@
+import argparse
+import os
+import pickle
+from collections import defaultdict
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+from datasets.cond_dataset import ecg_window, ecg_label
+
+
+def convert_record(job, dataset_path, freq, sec, with_index):
+    # every window of one record file is cut from a single unpickle
+    filename, entries = job
+    with open(os.path.join(dataset_path, filename), 'rb') as f:
+        data = pickle.load(f)
+    label = ecg_label(data['label'])
+
+    positions, windows, indices = [], [], []
+    for position, start in entries:
+        positions.append(position)
+        windows.append(ecg_window(data, start, freq, sec).astype(np.float32))
+        if with_index:
+            indices.append(np.load(os.path.join(dataset_path, filename.split('.')[0] + f'_{start}_index_100.npy')))
+    return positions, windows, label, indices
+
+
+def convert(args, type):
+    with open(os.path.join(args.dataset_path, f'{args.dataset_name}_{type}_ECGlist2.pk'), 'rb') as f:
+        file_list = pickle.load(f)
+
+    records = defaultdict(list)
+    for position, entry in enumerate(file_list):
+        records[entry[:-1]].append((position, int(entry[-1])))
+
+    # precomputed test indices are packed as well when they exist
+    first = file_list[0]
+    with_index = type == 'test' and os.path.isfile(os.path.join(args.dataset_path, first[:-1].split('.')[0] + f'_{first[-1]}_index_100.npy'))
+
+    output_path = args.output_path or args.dataset_path
+    os.makedirs(output_path, exist_ok=True)
+    prefix = os.path.join(output_path, f'{args.dataset_name}_{type}_ECG')
+    windows = np.lib.format.open_memmap(prefix + '_windows.npy', mode='w+', dtype=np.float32, shape=(len(file_list), args.freq*args.sec))
+    labels = np.zeros(len(file_list), dtype=np.int64)
+    # windows cut short by the end of their record are zero-padded, their lengths are kept for bucketing
+    lengths = np.zeros(len(file_list), dtype=np.int64)
+    index = np.lib.format.open_memmap(prefix + '_index.npy', mode='w+', dtype=np.int64, shape=(len(file_list), 100)) if with_index else None
+
+    job = partial(convert_record, dataset_path=args.dataset_path, freq=args.freq, sec=args.sec, with_index=with_index)
+    with Pool(args.num_workers) as pool:
+        for positions, record_windows, label, indices in pool.imap_unordered(job, records.items(), chunksize=16):
+            for position, window in zip(positions, record_windows):
+                windows[position, :len(window)] = window
+                lengths[position] = len(window)
+            labels[positions] = label
+            if with_index:
+                index[positions] = np.stack(indices)
+
+    windows.flush()
+    np.save(prefix + '_labels.npy', labels)
+    if (lengths < args.freq*args.sec).any():
+        np.save(prefix + '_lengths.npy', lengths)
+    if with_index:
+        index.flush()
+    print(f'{type}: {len(file_list)} windows from {len(records)} records saved at {prefix}_windows.npy')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='convert the pickled ECG records into memory-mapped window arrays')
+    parser.add_argument('--dataset_path', type=str, default='./input/')
+    parser.add_argument('--dataset_name', type=str)
+    parser.add_argument('--output_path', type=str, default=None, help='defaults to dataset_path')
+    parser.add_argument('--types', nargs='+', default=['train', 'eval', 'test'])
+    parser.add_argument('--freq', type=int, default=500)
+    parser.add_argument('--sec', type=int, default=1)
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    for type in args.types:
+        convert(args, type)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,123 @@
 import torch
-from torch.utils.data import DataLoader, Dataset
+import torch.nn as nn
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Sampler, BatchSampler, RandomSampler, SequentialSampler, DistributedSampler, get_worker_info
 
+import math
 import pickle
 import os
 import numpy as np
+from functools import partial
 
+from models.FourierModel import harmonic_frequencies
+from utils.trainer_utils import pin_worker
 
-def get_dataloader(args, type):
-    if args.dataset_type == 'sin':
+
+def get_dataloader(args, type, shuffle=True, shard=True):
+    # under torchrun every process reads its own shard, batch_size is per process, see DistributedSampler.set_epoch
+    worker_init_fn = partial(pin_worker, cores=args.worker_cores) if args.worker_cores else None
+    pin_memory = torch.device(args.device).type == 'cuda'
+    distributed = shard and getattr(args, 'world_size', 1) > 1
+    # training shards are padded to the same number of steps on every rank, eval shards are not padded,
+    # so the all-reduced eval metrics are those of a single process
+    pad = type == 'train'
+
+    if args.dataset_type == 'sin' and getattr(args, 'sin_stream', False):
+        # batches are generated inside the workers, each rank draws its own stream
+        data = SinStreamDataset(args, type, rank=args.rank if distributed else 0)
+        dataloader = DataLoader(dataset=data, batch_size=None, num_workers=args.num_workers,
+                                worker_init_fn=worker_init_fn, pin_memory=pin_memory)
+
+    elif args.dataset_type == 'sin':
         data = SinDataset(args, type)
-        dataloader = DataLoader(dataset=data, batch_size=args.batch_size, shuffle=True)
+        if distributed and pad:
+            sampler = DistributedSampler(data, num_replicas=args.world_size, rank=args.rank, shuffle=shuffle)
+        elif distributed:
+            sampler = range(args.rank, len(data), args.world_size)
+        else:
+            sampler = RandomSampler(data) if shuffle else SequentialSampler(data)
+        # whole batches are fetched at once, see SinDataset.get_batch
+        sampler = BatchSampler(sampler, batch_size=args.batch_size, drop_last=False)
+        dataloader = DataLoader(dataset=data, sampler=sampler, batch_size=None, num_workers=args.num_workers,
+                                worker_init_fn=worker_init_fn, pin_memory=pin_memory)
 
     elif args.dataset_type == 'ECG':
-        data = ECGDataset(args, type)
-        dataloader = DataLoader(dataset=data, batch_size=args.batch_size, shuffle=True, num_workers=16)
+        data = ECGMmapDataset(args, type) if args.ecg_mmap else ECGDataset(args, type)
+        if getattr(args, 'bucket_batches', False) and data.lengths is not None:
+            # batches of similar lengths, padded only up to their own longest window
+            batch_sampler = LengthBucketBatchSampler(data.lengths, args.batch_size, shuffle=shuffle, seed=getattr(args, 'seed', 0),
+                                                     num_replicas=args.world_size if distributed else 1, rank=args.rank if distributed else 0,
+                                                     pad=pad)
+            dataloader = DataLoader(dataset=data, batch_sampler=batch_sampler, num_workers=args.num_workers,
+                                    collate_fn=data.collate, worker_init_fn=worker_init_fn, pin_memory=pin_memory)
+        else:
+            if distributed and pad:
+                sampler = DistributedSampler(data, num_replicas=args.world_size, rank=args.rank, shuffle=shuffle)
+            else:
+                sampler = range(args.rank, len(data), args.world_size) if distributed else None
+            dataloader = DataLoader(dataset=data, batch_size=args.batch_size, shuffle=shuffle and sampler is None, sampler=sampler,
+                                    num_workers=args.num_workers, collate_fn=data.collate, worker_init_fn=worker_init_fn, pin_memory=pin_memory)
     return dataloader
 
 
+def observations(sample, device='cpu'):
+    # the observed points obs_t (B, N)  obs_x (B, N, 1)  label (B) of a batch, obs_lengths (B) of padded ECG batches (else None)
+    # and its dense (B, S) time grid, on device
+    samp_sin = sample['sin'].to(device)
+    index = sample['index'].to(device)
+    orig_ts = sample['orig_ts'].to(device)
+    if orig_ts.dim() == 1:
+        orig_ts = orig_ts.expand(samp_sin.size(0), orig_ts.size(0))
+    obs_t = torch.gather(orig_ts, 1, index)
+    obs_x = torch.gather(samp_sin, 1, index.unsqueeze(-1))
+    obs_lengths = sample['obs_lengths'].to(device) if 'obs_lengths' in sample else None
+    return obs_t, obs_x, sample['label'].squeeze(-1).to(device), obs_lengths, orig_ts
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Shuffles the samples, sorts every pool of pool_batches * batch_size of them by length, cuts the pools into batches
+    and shuffles the batches, so a batch mixes little padding with random order. The order depends on (seed, epoch) only,
+    under torchrun every rank takes every num_replicas-th batch, padded to the same number of batches unless pad=False.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, pool_batches=100, seed=0, num_replicas=1, rank=0, pad=True):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = pool_batches * batch_size
+        self.seed, self.epoch = seed, 0
+        self.num_replicas, self.rank = num_replicas, rank
+        self.pad = pad
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.lengths), generator=generator) if self.shuffle else torch.arange(len(self.lengths))
+        pools = order.split(self.pool_size) if self.shuffle else [order]
+
+        batches = []
+        for pool in pools:
+            pool = pool[torch.argsort(self.lengths[pool], stable=True)]
+            batches += [batch.tolist() for batch in pool.split(self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+        if self.pad:
+            per_replica = math.ceil(len(batches) / self.num_replicas)
+            batches += batches[:per_replica * self.num_replicas - len(batches)]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        n_batches = math.ceil(len(self.lengths) / self.batch_size)
+        if not self.pad:
+            return len(range(self.rank, n_batches, self.num_replicas))
+        return math.ceil(n_batches / self.num_replicas)
+
+
 
 class SinDataset(Dataset):
     def __init__(self, args, type):
@@ -29,30 +130,142 @@ class SinDataset(Dataset):
         self.sin = dataset[f'{type}_sin']
         self.orig_ts = dataset['orig_ts']
         self.label = dataset[f'{type}_label']
+        self.n_obs = getattr(args, 'n_obs', 500)
 
 
     def __len__(self):
         return self.sin.size(0)
 
     def __getitem__(self, item):
-        index = np.sort(np.random.choice(self.orig_ts.size(0), 500, replace=False))
+        # a list of items comes from the batch sampler
+        if isinstance(item, list):
+            return self.get_batch(item)
+
+        index = np.sort(np.random.choice(self.orig_ts.size(0), self.n_obs, replace=False))
         return {'sin': self.sin[item],
                 'label': self.label[item],
                 'orig_ts': self.orig_ts,
                 'index': index}
 
+    def get_batch(self, items):
+        # orig_ts is returned once as (S) and broadcast by the model instead of stacked B times
+        items = torch.as_tensor(items)
+        return {'sin': self.sin[items],
+                'label': self.label[items],
+                'orig_ts': self.orig_ts,
+                'index': self.sample_index(items.size(0))}
+
+    def sample_index(self, B):
+        # sorted random index sets without replacement for the whole batch in one op
+        return torch.rand(B, self.orig_ts.size(0)).argsort(dim=-1)[:, :self.n_obs].sort(dim=-1)[0]  # (B, N)
+
+
+class SinStreamDataset(IterableDataset):
+    """
+    Labeled sin mixtures generated on the fly, in the batch format of SinDataset.get_batch.
+    Every label owns a fixed subset of the lower_bound / upper_bound / skip_step frequencies with fixed amplitudes,
+    each sample jitters the amplitudes and draws random phases. Batch b of an epoch is generated from
+    (seed, type, epoch, rank, b) alone, so the stream does not depend on the number of workers and eval is the same every epoch.
+    """
+    types = ['train', 'eval', 'test']
+
+    def __init__(self, args, type, rank=0):
+        super(SinStreamDataset, self).__init__()
+        assert type in self.types, 'type should be train or eval or test'
+        self.type = type
+        self.rank = rank
+        self.seed = args.seed
+        self.epoch = 0
+        self.batch_size = args.batch_size
+        self.n_batches = args.stream_batches
+        self.n_obs = getattr(args, 'n_obs', 500)
+        self.orig_ts = torch.linspace(0, 1, args.stream_seq_len)
+
+        freqs = torch.tensor(harmonic_frequencies(args.lower_bound, args.upper_bound, args.skip_step), dtype=torch.float)
+        n_components = min(3, freqs.size(0))
+        # per label signature, drawn from a generator of its own so it is the same for every split, rank and epoch
+        generator = torch.Generator().manual_seed(self.seed)
+        self.label_freqs = torch.stack([freqs[torch.randperm(freqs.size(0), generator=generator)[:n_components]] for _ in range(args.num_label)])  # (L, C)
+        self.label_amps = 0.5 + torch.rand(args.num_label, n_components, generator=generator)  # (L, C)
+
+    def __len__(self):
+        # the stream yields whole batches, so len(dataloader) is the number of batches per epoch
+        return self.n_batches
+
+    def set_epoch(self, epoch):
+        # only the training stream changes across epochs
+        if self.type == 'train':
+            self.epoch = epoch
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        for batch in range(worker_id, self.n_batches, num_workers):
+            seed = np.random.SeedSequence([self.seed, self.types.index(self.type), self.epoch, self.rank, batch]).generate_state(1)[0]
+            yield self.generate(torch.Generator().manual_seed(int(seed)))
+
+    def generate(self, generator):
+        B, S = self.batch_size, self.orig_ts.size(0)
+        label = torch.randint(0, self.label_freqs.size(0), (B,), generator=generator)
+        freqs = self.label_freqs[label]  # (B, C)
+        amps = self.label_amps[label] * (0.8 + 0.4 * torch.rand(freqs.size(), generator=generator))
+        phases = 2 * math.pi * torch.rand(freqs.size(), generator=generator)
+
+        phase = 2 * math.pi * self.orig_ts.view(1, S, 1) * freqs.unsqueeze(1) + phases.unsqueeze(1)  # (B, S, C)
+        sin = (amps.unsqueeze(1) * torch.sin(phase)).sum(-1, keepdim=True)  # (B, S, 1)
+        index = torch.rand(B, S, generator=generator).argsort(dim=-1)[:, :self.n_obs].sort(dim=-1)[0]  # (B, N)
+        return {'sin': sin,
+                'label': label.unsqueeze(-1),
+                'orig_ts': self.orig_ts,
+                'index': index}
+
+
+def load_ecg_window(dataset_path, entry, freq=500, sec=1):
+    # entry is '<record file><window start>', returns the lead 11 window normalized to [-10, 10] and its label
+    start = int(entry[-1])
+    with open(os.path.join(dataset_path, entry[:-1]), 'rb') as f:
+        data = pickle.load(f)
+    return ecg_window(data, start, freq, sec), ecg_label(data['label'])
+
+
+def ecg_window(data, start, freq=500, sec=1):
+    # sec seconds of lead 11 from second start, shorter when the record ends earlier (padded by the loaders)
+    record = np.int32(data['val'][11][freq*start:freq*(start+sec)])
+
+    record_max = record.max() ; record_min = record.min()
+    record = (((record - record_min) / (record_max - record_min)) - 0.5)*20    # normalize to -10 to 10
+    return record
+
+
+def ecg_label(raw_label):
+    if raw_label[0] == 1:
+        return 0
+    elif raw_label[1] == 1:
+        return 1
+    elif raw_label[3] == 1:
+        return 2
+    else:
+        raise NotImplementedError
+
 
 class ECGDataset(Dataset):
+    # sampling bins over the normalized [-10, 10] range: [-10, -6), [-6, -2), [-2, 2), [2, 6), [6, 10]
+    bin_edges = torch.FloatTensor([-6, -2, 2, 6])
+
     def __init__(self, args, type):
         super(ECGDataset, self).__init__()
         assert type in ['train', 'eval', 'test'], 'type should be train or eval or test'
         self.dataset_path = args.dataset_path
         self.freq = 500
-        self.sec = 1
+        self.sec = getattr(args, 'ecg_seconds', 1)
         self.type = type
+        self.n_obs = getattr(args, 'n_obs', 500)
+        self.orig_ts = torch.linspace(0, self.sec, self.sec*self.freq)
 
         with open(os.path.join(self.dataset_path, f'{args.dataset_name}_{type}_ECGlist2.pk'), 'rb') as f:
             self.file_list = pickle.load(f)
+        # window lengths are only known once a record is read, windows at the end of a record can be shorter
+        self.lengths = None
 
         self.ECG_type = 'V6'
 
@@ -71,53 +284,93 @@ class ECGDataset(Dataset):
         self.filename = filename
         start = int(filename[-1])
         filename = filename[:-1]
-        with open(os.path.join(self.dataset_path, filename), 'rb') as f:
-            data = pickle.load(f)
-        record = np.int32(data['val'][11][500*start:500*(start+1)])
-
-        record_max = record.max() ; record_min = record.min()
-        record = (((record - record_min) / (record_max - record_min)) - 0.5)*20    # normalize to -10 to 10
+        record, data_label = load_ecg_window(self.dataset_path, self.file_list[item], self.freq, self.sec)
 
+        # train / eval indices are drawn for the whole batch in collate
+        sample = {'sin': torch.FloatTensor(record).unsqueeze(-1),
+                  'label': torch.LongTensor([data_label])}
         if self.type == 'test':
             index_filename = filename.split('.')[0] + f'_{start}_index_100.npy'
+            sample['index'] = torch.from_numpy(np.load(os.path.join(self.dataset_path, index_filename)))
+        return sample
+
+    def collate(self, batch):
+        # stacks the items, shares orig_ts as (S) and samples indices for the whole batch at once
+        lengths = torch.tensor([sample['sin'].size(0) for sample in batch])
+        label = torch.stack([sample['label'] for sample in batch])
+        if (lengths == self.orig_ts.size(0)).all():
+            sin = torch.stack([sample['sin'] for sample in batch])  # (B, S, 1)
+            if 'index' in batch[0]:
+                index = torch.stack([sample['index'] for sample in batch])
+            else:
+                index = self.batch_sampling(sin.squeeze(-1))
+            return {'sin': sin,
+                    'orig_ts': self.orig_ts,
+                    'label': label,
+                    'index': index}
+
+        # shorter windows are right-padded to the longest of the batch, obs_lengths counts the valid indices
+        sin = nn.utils.rnn.pad_sequence([sample['sin'] for sample in batch], batch_first=True)  # (B, S, 1)
+        if 'index' in batch[0]:
+            index = torch.stack([sample['index'] for sample in batch])
+            obs_lengths = torch.full((len(batch),), index.size(1))
         else:
-            index = self.sampling(record)
-
-        # label
-        raw_label = data['label']
-        data_label = None
-
-        if raw_label[0] == 1:
-            data_label = torch.LongTensor([0])
-        elif raw_label[1] == 1:
-            data_label = torch.LongTensor([1])
-        elif raw_label[3] == 1:
-            data_label = torch.LongTensor([2])
-        else:
-            raise NotImplementedError
+            index, obs_lengths = self.batch_sampling(sin.squeeze(-1), lengths)
+        return {'sin': sin,
+                'orig_ts': self.orig_ts[:sin.size(1)],
+                'label': label,
+                'index': index,
+                'obs_lengths': obs_lengths}
 
-        return {'sin': torch.FloatTensor(record).unsqueeze(-1),
-                'orig_ts': torch.linspace(0, self.sec, self.sec*self.freq),
-                'label': data_label,
-                'index': index}
+    def batch_sampling(self, records, lengths=None):
+        # records (B, S), histogram-stratified sampling per row, every non-empty bin gets the same total probability
+        # with lengths (B) of right-padded records also returns the number of valid indices per row
+        bins = torch.bucketize(records, self.bin_edges, right=True)  # (B, S)
+        if lengths is None:
+            hist = torch.zeros(records.size(0), 5).scatter_add_(1, bins, torch.ones_like(records))  # (B, 5)
+            prob = 0.2 / hist.gather(1, bins)
+            index = torch.sort(torch.multinomial(prob, self.n_obs, replacement=False), dim=-1)[0]  # (B, N)
+            return index
+
+        valid = torch.arange(records.size(1)) < lengths.unsqueeze(-1)  # (B, S)
+        hist = torch.zeros(records.size(0), 5).scatter_add_(1, bins, valid.float())
+        prob = torch.where(valid, 0.2 / hist.gather(1, bins), torch.zeros_like(records))
+        # Gumbel top-k draws without replacement like multinomial, rows with fewer valid points than N
+        # fill up with padded positions, which sort behind the valid ones
+        N = min(self.n_obs, records.size(1))
+        keys = torch.log(prob) - torch.log(-torch.log(torch.rand_like(prob)))
+        index = torch.sort(keys.topk(N, dim=-1)[1], dim=-1)[0]  # (B, N)
+        return index, lengths.clamp(max=N)
+
+
+class ECGMmapDataset(ECGDataset):
+    """ECG windows read from the memory-mapped arrays written by convert_ecg.py"""
+    def __init__(self, args, type):
+        super(ECGDataset, self).__init__()
+        assert type in ['train', 'eval', 'test'], 'type should be train or eval or test'
+        self.dataset_path = args.dataset_path
+        self.freq = 500
+        self.sec = getattr(args, 'ecg_seconds', 1)
+        self.type = type
+        self.n_obs = getattr(args, 'n_obs', 500)
+
+        prefix = os.path.join(self.dataset_path, f'{args.dataset_name}_{type}_ECG')
+        # copy-on-write maps are writable, so torch.from_numpy shares memory with the page cache
+        self.windows = np.load(prefix + '_windows.npy', mmap_mode='c')  # (N, freq*sec) float32, already normalized
+        self.labels = np.load(prefix + '_labels.npy')  # (N)
+        self.index = np.load(prefix + '_index.npy', mmap_mode='c') if os.path.isfile(prefix + '_index.npy') else None
+        # windows cut short by the end of their record are zero-padded in the array, their lengths are stored next to it
+        self.lengths = np.load(prefix + '_lengths.npy') if os.path.isfile(prefix + '_lengths.npy') else None
+        self.orig_ts = torch.linspace(0, self.sec, self.sec*self.freq)
+        assert self.windows.shape[1] == self.orig_ts.size(0), f'windows of {prefix} are not {self.sec} seconds long'
 
-    def sampling(self, record):
-        record = torch.FloatTensor(record)
-        hist = torch.histc(record, bins=5)
-
-        def cal_prob(x, hist):
-            if -10 <= x < -6:
-                prob = 0.2 / hist[0].item()
-            elif -6 <= x < -2:
-                prob = 0.2 / hist[1].item()
-            elif -2 <= x < 2:
-                prob = 0.2 / hist[2].item()
-            elif 2 <= x < 6:
-                prob = 0.2 / hist[3].item()
-            elif 6 <= x <= 10:
-                prob = 0.2 / hist[4].item()
-            return prob
-
-        prob = [cal_prob(x.item(), hist) for x in record]
-        index = torch.sort(torch.multinomial(torch.FloatTensor(prob), 500, replacement=False))[0]
-        return index
\ No newline at end of file
+    def __len__(self):
+        return self.windows.shape[0]
+
+    def __getitem__(self, item):
+        window = self.windows[item] if self.lengths is None else self.windows[item, :self.lengths[item]]
+        sample = {'sin': torch.from_numpy(window).unsqueeze(-1),
+                  'label': torch.LongTensor([self.labels[item]])}
+        if self.index is not None:
+            sample['index'] = torch.from_numpy(self.index[item])
+        return sample
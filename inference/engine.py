@@ -0,0 +1,149 @@
+import torch
+
+import argparse
+import copy
+import math
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+
+from models.latentmodel import ConditionalQueryFNP
+from models.quantization import quantized_model
+from utils.model_utils import autocast, fast_path_error
+
+
+def load_model(checkpoint, device='cpu', args=None):
+    # rebuilds ConditionalQueryFNP from a trainer checkpoint, or an int8 artifact of inference/quantize.py,
+    # args default to the ones saved with it
+    ckpt = torch.load(checkpoint, map_location=device)
+    if args is None:
+        assert 'args' in ckpt, 'checkpoint has no saved args, pass the training args explicitly'
+        args = argparse.Namespace(**ckpt['args'])
+    args.device = str(device)
+
+    if 'quantization' in ckpt:
+        assert torch.device(device).type == 'cpu', 'quantized models only run on CPU'
+        model = quantized_model(args, ckpt['quantization'])
+    else:
+        model = ConditionalQueryFNP(args).to(device)
+    model.load_state_dict(ckpt['model_state_dict'])
+    model.eval()
+    return model, args
+
+
+def synthetic_sample(args, B=8, S=1000):
+    # a batch in the layout of the dataloaders: labeled sums of random sinusoids on a grid starting at the training grid origin
+    generator = torch.Generator().manual_seed(0)
+    orig_ts = getattr(args, 'time_origin', 0.) + torch.linspace(0, 1, S)
+    freqs = torch.randint(1, 10, (B, 3), generator=generator).float()
+    phases = torch.rand(B, 3, generator=generator) * 2 * math.pi
+    sin = torch.sin(2 * math.pi * freqs.unsqueeze(1) * orig_ts.view(1, S, 1) + phases.unsqueeze(1)).sum(-1, keepdim=True)  # (B, S, 1)
+    N = min(getattr(args, 'n_obs', 500), S)
+    index = torch.rand(B, S, generator=generator).argsort(dim=-1)[:, :N].sort(dim=-1)[0]  # (B, N)
+    label = torch.randint(0, args.num_label, (B, 1), generator=generator)
+    return {'sin': sin, 'label': label, 'orig_ts': orig_ts, 'index': index}
+
+
+class InferenceEngine():
+    """
+    Serves reconstruction / extrapolation requests from one loaded checkpoint.
+    Concurrent requests are coalesced into micro-batches: a batch is run once it holds max_batch_size
+    requests or max_latency seconds after its first request arrived, whichever comes first.
+    A compiled / scripted / bf16 engine refuses to start when it deviates from the eager fp32 model by more than
+    fast_path_tol on sample, a dataloader batch, or on a synthetic batch.
+    """
+    def __init__(self, checkpoint, device='cpu', max_batch_size=64, max_latency=0.005, args=None, compile='none', bf16=False,
+                 fast_path_tol=None, sample=None):
+        self.device = torch.device(device)
+        self.model, self.args = load_model(checkpoint, self.device, args)
+        self.bf16 = bf16
+        self.fast_path_error = None
+        if compile != 'none' or bf16:
+            reference = copy.deepcopy(self.model)
+            self.model.accelerate(compile)
+            self.fast_path_error = fast_path_error(reference, self.model, sample if sample is not None else synthetic_sample(self.args),
+                                                   self.device, bf16)
+            tolerance = fast_path_tol if fast_path_tol is not None else (5e-2 if bf16 else 1e-4)
+            assert self.fast_path_error <= tolerance, \
+                f'fast path deviates from eager fp32 by {self.fast_path_error:.2e} (tolerance {tolerance:.0e})'
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, obs_t, obs_x, label, query_t, t0=None):
+        # obs_t (N)  obs_x (N)  label int  query_t (Q), returns a Future of the (Q) decoded values
+        # t0 the time of the ODE latent state, defaults to the origin of the training grid
+        future = Future()
+        request = (torch.as_tensor(obs_t, dtype=torch.float),
+                   torch.as_tensor(obs_x, dtype=torch.float).reshape(-1, 1),
+                   int(label),
+                   torch.as_tensor(query_t, dtype=torch.float),
+                   None if t0 is None else float(t0))
+        self.queue.put((request, future))
+        return future
+
+    def predict(self, obs_t, obs_x, label, query_t, t0=None):
+        return self.submit(obs_t, obs_x, label, query_t, t0).result()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def loop(self):
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_latency
+
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+
+            self.run(batch)
+
+    def run(self, batch):
+        # the encoder needs equal observation counts and a forward has one t0, so a micro-batch runs one forward
+        # per observation length and t0
+        groups = defaultdict(list)
+        for request, future in batch:
+            groups[(request[0].size(0), request[4])].append((request, future))
+
+        for group in groups.values():
+            try:
+                outputs = self.forward([request for request, _ in group])
+            except Exception as e:
+                for _, future in group:
+                    future.set_exception(e)
+                continue
+            for (_, future), output in zip(group, outputs):
+                future.set_result(output)
+
+    def forward(self, requests):
+        # queries are padded with their last time, which leaves pointwise and causal decoders unchanged
+        Q = max(request[3].size(0) for request in requests)
+        query_t = torch.stack([torch.cat((request[3], request[3][-1:].expand(Q - request[3].size(0)))) for request in requests])
+
+        obs_t = torch.stack([request[0] for request in requests]).to(self.device)
+        obs_x = torch.stack([request[1] for request in requests]).to(self.device)
+        label = torch.LongTensor([request[2] for request in requests]).to(self.device)
+
+        with torch.inference_mode(), autocast(self.device, self.bf16):
+            output = self.model.reconstruct(obs_t, obs_x, label, query_t.to(self.device), t0=requests[0][4]).float().cpu()
+        return [output[i, :request[3].size(0)].numpy() for i, request in enumerate(requests)]
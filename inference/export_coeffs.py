@@ -0,0 +1,70 @@
+import torch
+from torch.utils.data import IterableDataset
+import numpy as np
+
+import argparse
+import os
+
+from datasets.cond_dataset import get_dataloader, observations
+from inference.engine import load_model
+from models.FourierModel import ConditionalFNP
+
+
+def export(model, dataloader, prefix, device):
+    # encodes every sample into its (H, 2) sin / cos coefficients, in dataset order
+    decoder = model.decoder
+    if isinstance(dataloader.dataset, IterableDataset):
+        # a stream only knows its number of batches, its samples are counted by a first pass
+        N = sum(sample['sin'].size(0) for sample in dataloader)
+    else:
+        N = len(dataloader.dataset)
+    coeffs = np.lib.format.open_memmap(prefix + '_coeffs.npy', mode='w+', dtype=np.float32, shape=(N, decoder.n_harmonics, 2))
+    labels = np.zeros(N, dtype=np.int64)
+
+    position = 0
+    with torch.inference_mode():
+        for sample in dataloader:
+            # padded ECG batches only encode the valid observations of each window
+            obs_t, obs_x, label, obs_lengths, _ = observations(sample, device)
+            z, _ = model.encode(obs_t, obs_x, label, obs_lengths=obs_lengths)
+            B = z.size(0)
+            coeffs[position:position+B] = decoder.coeff_generator(z).cpu().numpy()
+            labels[position:position+B] = label.cpu().numpy()
+            position += B
+
+    coeffs.flush()
+    np.save(prefix + '_freqs.npy', decoder.basis.freqs.cpu().numpy())
+    np.save(prefix + '_labels.npy', labels)
+    return N
+
+
+def main():
+    parser = argparse.ArgumentParser(description='export per-sample Fourier coefficients into a memory-mapped store')
+    parser.add_argument('--checkpoint', type=str, help='a checkpoint of a Fourier decoder model')
+    parser.add_argument('--output', type=str, help='prefix of the written _coeffs.npy / _freqs.npy / _labels.npy files')
+    parser.add_argument('--type', choices=['train', 'eval', 'test'], default='test')
+    parser.add_argument('--dataset_path', type=str, default=None, help='defaults to the one saved in the checkpoint')
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model, model_args = load_model(args.checkpoint, device)
+    assert isinstance(model.decoder, ConditionalFNP), 'coefficients can only be exported from the Fourier decoder'
+
+    model_args.batch_size = args.batch_size
+    model_args.num_workers = args.num_workers
+    model_args.worker_cores = None
+    model_args.world_size = 1
+    model_args.ecg_mmap = getattr(model_args, 'ecg_mmap', False)
+    if args.dataset_path is not None:
+        model_args.dataset_path = args.dataset_path
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    N = export(model, get_dataloader(model_args, args.type, shuffle=False), args.output, device)
+    print(f'{N} samples exported at {args.output}_coeffs.npy')
+
+
+if __name__ == '__main__':
+    main()
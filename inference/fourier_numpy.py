@@ -0,0 +1,31 @@
+"""NumPy-only evaluation of exported Fourier coefficients, importing this module does not import torch."""
+import numpy as np
+
+
+def fourier_series(coeffs, freqs, t):
+    # coeffs (..., H, 2) as (sin, cos)  freqs (H)  t (S) -> (..., S)
+    phase = 2 * np.pi * np.asarray(t, dtype=np.float64)[:, None] * freqs[None, :]  # (S, H)
+    return coeffs[..., 1] @ np.cos(phase).T + coeffs[..., 0] @ np.sin(phase).T
+
+
+class FourierCoefficientStore():
+    """
+    Reads the coefficient store written by inference/export_coeffs.py:
+    {prefix}_coeffs.npy (N, H, 2) memory-mapped, {prefix}_freqs.npy (H) and {prefix}_labels.npy (N).
+    """
+    def __init__(self, prefix):
+        self.coeffs = np.load(prefix + '_coeffs.npy', mmap_mode='r')
+        self.freqs = np.load(prefix + '_freqs.npy').astype(np.float64)
+        self.labels = np.load(prefix + '_labels.npy')
+
+    def __len__(self):
+        return self.coeffs.shape[0]
+
+    def reconstruct(self, item, t):
+        # item int, slice or index array  t (S) -> (S) or (B, S)
+        return fourier_series(np.asarray(self.coeffs[item], dtype=np.float64), self.freqs, t)
+
+    def render(self, item, n_points=500, start=0., end=1.):
+        # evaluates the series on a regular grid of any resolution and time range
+        t = np.linspace(start, end, n_points)
+        return t, self.reconstruct(item, t)
@@ -0,0 +1,87 @@
+import torch
+
+import argparse
+import copy
+import os
+import time
+
+from datasets.cond_dataset import get_dataloader, observations
+from inference.engine import load_model
+from models.quantization import quantize, save_quantized
+
+
+def compare(model, qmodel, batches):
+    # dense reconstruction MSE of both models against the signal, the MSE between them and their mean latency per batch
+    totals = {'fp32_mse': 0., 'int8_mse': 0., 'drift_mse': 0., 'fp32_ms': 0., 'int8_ms': 0.}
+    N = 0
+    with torch.inference_mode():
+        for obs_t, obs_x, label, obs_lengths, orig_ts, signal in batches:
+            starttime = time.perf_counter()
+            reference = model.reconstruct(obs_t, obs_x, label, orig_ts, obs_lengths=obs_lengths)
+            middletime = time.perf_counter()
+            output = qmodel.reconstruct(obs_t, obs_x, label, orig_ts, obs_lengths=obs_lengths)
+            endtime = time.perf_counter()
+
+            B = signal.size(0)
+            totals['fp32_mse'] += ((reference - signal) ** 2).mean().item() * B
+            totals['int8_mse'] += ((output - signal) ** 2).mean().item() * B
+            totals['drift_mse'] += ((output - reference) ** 2).mean().item() * B
+            totals['fp32_ms'] += (middletime - starttime) * 1e3
+            totals['int8_ms'] += (endtime - middletime) * 1e3
+            N += B
+
+    report = {name: value / N for name, value in totals.items() if name.endswith('mse')}
+    report.update({name: value / len(batches) for name, value in totals.items() if name.endswith('ms')})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='post-training int8 quantization of a checkpoint for CPU inference')
+    parser.add_argument('--checkpoint', type=str, help='an fp32 trainer checkpoint')
+    parser.add_argument('--output', type=str, help='path of the quantized artifact, loadable by inference.engine.load_model')
+    parser.add_argument('--type', choices=['train', 'eval', 'test'], default='eval', help='split used for calibration and the report')
+    parser.add_argument('--dataset_path', type=str, default=None, help='defaults to the one saved in the checkpoint')
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--calibration_batches', type=int, default=8, help='batches encoded to calibrate the static encoder')
+    parser.add_argument('--report_batches', type=int, default=8, help='batches after the calibration ones used for the MSE drift report')
+    parser.add_argument('--no_static_encoder', action='store_true', help='only quantize the linear / GRU layers dynamically')
+    parser.add_argument('--engine', type=str, default='x86', help='quantized backend, x86 / fbgemm on servers, qnnpack on ARM')
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    model, model_args = load_model(args.checkpoint, 'cpu')
+
+    data_args = copy.copy(model_args)
+    data_args.batch_size = args.batch_size
+    data_args.num_workers = 0
+    data_args.worker_cores = None
+    data_args.world_size = 1
+    data_args.ecg_mmap = getattr(model_args, 'ecg_mmap', False)
+    if args.dataset_path is not None:
+        data_args.dataset_path = args.dataset_path
+
+    # the eval index sampling is random, a fixed seed keeps the calibration set and the report reproducible
+    torch.manual_seed(0)
+    batches = []
+    for sample in get_dataloader(data_args, args.type, shuffle=False):
+        # (obs_t, obs_x, label, obs_lengths, orig_ts, signal)
+        batches.append(observations(sample) + (sample['sin'].squeeze(-1),))
+        if len(batches) == args.calibration_batches + args.report_batches:
+            break
+    calibration, report_batches = batches[:args.calibration_batches], batches[args.calibration_batches:] or batches
+
+    static_encoder = not args.no_static_encoder
+    qmodel = quantize(model, [batch[:4] for batch in calibration], static_encoder=static_encoder, engine=args.engine)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    save_quantized(qmodel, model_args, args.output, static_encoder=static_encoder, engine=args.engine)
+
+    report = compare(model, qmodel, report_batches)
+    print(f"[MSE] fp32: {report['fp32_mse']:.6f}  int8: {report['int8_mse']:.6f}  drift (int8 vs fp32): {report['drift_mse']:.2e}")
+    print(f"[Latency / batch] fp32: {report['fp32_ms']:.2f}ms  int8: {report['int8_ms']:.2f}ms  speedup: {report['fp32_ms'] / report['int8_ms']:.2f}x")
+    print(f'Quantized model saved at {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import torch
+
+import argparse
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from inference.engine import InferenceEngine
+
+
+def make_handler(engine):
+    class PredictHandler(BaseHTTPRequestHandler):
+        # POST /predict {"obs_t": [...], "obs_x": [...], "label": int, "query_t": [...], optional "t0": float} -> {"output": [...]}
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_error(404)
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                output = engine.predict(request['obs_t'], request['obs_x'], request['label'], request['query_t'], request.get('t0'))
+                body, status = json.dumps({'output': output.tolist()}).encode(), 200
+            except Exception as e:
+                body, status = json.dumps({'error': str(e)}).encode(), 400
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return PredictHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='local HTTP front end for load testing the inference engine')
+    parser.add_argument('--checkpoint', type=str, help='a _best.pt checkpoint written by the trainer')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--max_batch_size', type=int, default=64)
+    parser.add_argument('--max_latency', type=float, default=0.005, help='seconds a micro-batch waits for more requests')
+    parser.add_argument('--compile', choices=['none', 'compile', 'script'], default='none')
+    parser.add_argument('--bf16', action='store_true')
+    parser.add_argument('--fast_path_tol', type=float, default=None, help='max relative error of --compile / --bf16 against eager fp32, defaults to 1e-4 (5e-2 with bf16)')
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    engine = InferenceEngine(args.checkpoint, args.device, args.max_batch_size, args.max_latency, compile=args.compile, bf16=args.bf16,
+                             fast_path_tol=args.fast_path_tol)
+    if engine.fast_path_error is not None:
+        print(f'[Fast path] compile: {args.compile}  bf16: {args.bf16}  relative error: {engine.fast_path_error:.2e}')
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(engine))
+    print(f'Serving {args.checkpoint} at http://{args.host}:{args.port}/predict')
+    try:
+        server.serve_forever()
+    finally:
+        engine.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,8 @@ import random
 import numpy as np
 import os
 
-from trainer.ConditionalTrainer import ConditionalNPTrainer as Trainer
+from trainer.ConditionalTrainer import ConditionalNPTrainer, ConditionalEnsembleTrainer
+from utils.trainer_utils import setup_device, setup_distributed
 
 def main():
     parser = argparse.ArgumentParser()
@@ -31,17 +32,77 @@ def main():
     parser.add_argument('--lower_bound', type=float, default=1)
     parser.add_argument('--upper_bound', type=float)
     parser.add_argument('--skip_step', type=int)
+    parser.add_argument('--ode_method', type=str, default='rk4', help='any torchdiffeq solver, e.g. rk4, euler, dopri5')
+    parser.add_argument('--ode_rtol', type=float, default=1e-7)
+    parser.add_argument('--ode_atol', type=float, default=1e-9)
+    parser.add_argument('--ode_step_size', type=float, default=None, help='step size for fixed-grid solvers, defaults to the query spacing')
+    parser.add_argument('--ode_adjoint', action='store_true', help='backpropagate with the adjoint method')
+    parser.add_argument('--basis_cache_size', type=int, default=8, help='number of time grids whose Fourier basis is cached')
+    parser.add_argument('--fourier_engine', type=str, default='auto', choices=['auto', 'direct', 'fft'],
+                        help='dense renders on a regular grid by direct products or an inverse FFT, auto picks by H and S')
+    parser.add_argument('--decode_tile', type=int, default=None, help='decode Fourier / NP queries in tiles of this size, recomputed in backward')
 
     parser.add_argument('--lr', type=float, default=1e-4)
     parser.add_argument('--n_epochs', type=int, default=1000)
     parser.add_argument('--batch_size', type=int, default=512)
     parser.add_argument('--dropout', type=float, default=0.1)
+    parser.add_argument('--fixed_eval', action='store_true', help='freeze the eval indices once per run and keep the eval set on the device')
+    parser.add_argument('--eval_batch_size', type=int, default=4096)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--ensemble', type=int, default=1, help='train K replicas seeded seed + k in one vectorized pass')
 
     parser.add_argument('--path', type=str, default='./', help='parameter saving path')
     parser.add_argument('--dataset_path', type=str, default='./input/')
     parser.add_argument('--dataset_name', type=str)
     parser.add_argument('--dataset_type', choices=['sin', 'ECG'])
-    parser.add_argument('--device_num', type=str, default='0')
+    parser.add_argument('--ecg_mmap', action='store_true', help='read ECG windows from the arrays written by convert_ecg.py')
+    parser.add_argument('--ecg_seconds', type=int, default=1, help='length of the 500 Hz ECG windows')
+    parser.add_argument('--n_obs', type=int, default=500, help='observed points sampled per series')
+    parser.add_argument('--bucket_batches', action='store_true', help='batch ECG windows of similar length, needs the lengths written by convert_ecg.py')
+    parser.add_argument('--sin_stream', action='store_true', help='generate labeled sin mixtures on the fly instead of reading the pickles')
+    parser.add_argument('--stream_batches', type=int, default=100, help='batches per epoch (per process) of the sin stream')
+    parser.add_argument('--stream_seq_len', type=int, default=1000, help='points per generated series on [0, 1]')
+    parser.add_argument('--device_num', type=str, default='0', help='CUDA_VISIBLE_DEVICES with --device auto or cuda, ignored for cuda:<index>')
+    parser.add_argument('--debug', action='store_true')
+
+    # Checkpoints
+    parser.add_argument('--resume', type=str, default=None, help='checkpoint file or run directory (its newest periodic checkpoint) to resume from')
+    parser.add_argument('--save_every', type=int, default=1, help='epochs between periodic checkpoints')
+    parser.add_argument('--keep_last', type=int, default=3, help='number of periodic checkpoints kept, the best checkpoint is always kept')
+
+    # Training control
+    parser.add_argument('--lr_schedule', type=str, default='constant', choices=['constant', 'cosine', 'plateau'])
+    parser.add_argument('--warmup_steps', type=int, default=0, help='steps of linear learning rate warmup')
+    parser.add_argument('--min_lr_ratio', type=float, default=0., help='final fraction of lr reached by the cosine schedule')
+    parser.add_argument('--plateau_patience', type=int, default=5, help='evaluations without improvement before the plateau schedule reduces lr')
+    parser.add_argument('--plateau_factor', type=float, default=0.5)
+    parser.add_argument('--patience', type=int, default=None, help='evaluations without improvement before early stopping, off by default')
+    parser.add_argument('--min_delta', type=float, default=0., help='eval loss change that counts as an improvement')
+    parser.add_argument('--max_steps', type=int, default=None, help='optimizer step budget, also the length of the cosine schedule')
+    parser.add_argument('--time_budget', type=float, default=None, help='wall-clock budget in minutes, summed over resumed runs')
+    parser.add_argument('--eval_every', type=int, default=1, help='initial epochs between evaluations')
+    parser.add_argument('--eval_slowdown', type=float, default=0.01, help='relative eval improvement below which the eval interval is halved')
+
+    # Device
+    parser.add_argument('--device', type=str, default='auto', help='auto, cpu, cuda or cuda:<index>')
+    parser.add_argument('--num_threads', type=int, default=None, help='intra-op threads, defaults to every available core on CPU')
+    parser.add_argument('--num_interop_threads', type=int, default=None)
+    parser.add_argument('--num_workers', type=int, default=None, help='DataLoader workers, defaults to 0 for sin and 16 for ECG')
+    parser.add_argument('--pin_workers', action='store_true', help='pin every DataLoader worker to a dedicated core')
+    parser.add_argument('--dist_backend', type=str, default='gloo', help='process group backend when launched with torchrun')
+
+    # Profiling
+    parser.add_argument('--log_every', type=int, default=100, help='steps between reduced metrics and rolling step-time summaries')
+    parser.add_argument('--metrics_jsonl', action='store_true', help='also write metrics to <run>_metrics.jsonl, always on without wandb')
+    parser.add_argument('--sync_timing', action='store_true', help='synchronize CUDA at every phase boundary for exact phase times')
+    parser.add_argument('--profile_wait', type=int, default=0, help='steps skipped before the torch.profiler window')
+    parser.add_argument('--profile_warmup', type=int, default=5)
+    parser.add_argument('--profile_active', type=int, default=0, help='steps traced by torch.profiler, 0 disables it')
+
+    # Fast paths
+    parser.add_argument('--compile', choices=['none', 'compile', 'script'], default='none', help='torch.compile or TorchScript the encoder and decoder')
+    parser.add_argument('--bf16', action='store_true', help='train and evaluate under bf16 autocast')
+    parser.add_argument('--fast_path_tol', type=float, default=None, help='max relative error against eager fp32, defaults to 1e-4 (5e-2 with bf16)')
     args = parser.parse_args()
 
     if args.dataset_type == 'sin':
@@ -49,19 +110,32 @@ def main():
     elif args.dataset_type == 'ECG':
         args.num_label = 3
 
+    if args.num_workers is None:
+        args.num_workers = 16 if args.dataset_type == 'ECG' else 0
+
     assert ((args.upper_bound - args.lower_bound + 1) == args.n_harmonics), "the number of harmonics and lower and upper bound should match"
 
-    os.environ['CUDA_VISIBLE_DEVICES'] = args.device_num
+    # the legacy --device_num only applies to auto / plain cuda, an explicit cuda:<index> selects that GPU,
+    # under torchrun each process picks its GPU by local rank instead
+    if args.device in ('auto', 'cuda') and 'WORLD_SIZE' not in os.environ:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.device_num
+    setup_distributed(args)
+    setup_device(args)
 
-    SEED = 1234
+    # DDP broadcasts the initial weights of rank 0, the per-rank seed only decorrelates sampling and dropout
+    SEED = args.seed + args.rank
     random.seed(SEED)
     np.random.seed(SEED)
     torch.manual_seed(SEED)
     torch.cuda.manual_seed(SEED)
     torch.backends.cudnn.deterministic = True
 
+    Trainer = ConditionalEnsembleTrainer if args.ensemble > 1 else ConditionalNPTrainer
     trainer = Trainer(args)
     trainer.train()
 
+    if args.world_size > 1:
+        torch.distributed.destroy_process_group()
+
 if __name__ == '__main__':
     main()
@@ -2,6 +2,22 @@ import torch
 import torch.nn as nn
 
 import math
+from collections import OrderedDict
+from fractions import Fraction
+
+
+def harmonic_frequencies(lower_bound, upper_bound, skip_step):
+    # same frequency layout as the harmonic loop: lower_bound, then every skip_step up to upper_bound
+    return [lower_bound] + list(range(int(lower_bound + skip_step), int(upper_bound + skip_step), int(skip_step)))
+
+
+def fft_cost(M):
+    # relative cost of a size M inverse FFT, sizes with a prime factor above 7 go through Bluestein at about 10x
+    n = M
+    for p in (2, 3, 5, 7):
+        while n % p == 0:
+            n //= p
+    return M * max(math.log2(M), 1) * (1 if n == 1 else 10)
 
 
 class QueryGenerator(nn.Module):
@@ -23,7 +39,7 @@ class QueryGenerator(nn.Module):
 
         # harmonic embedding
         self.harmonic_embedding = nn.Embedding(args.n_harmonics, args.latent_dimension + args.num_label)
-        self.harmonics = torch.linspace(0, self.n_harmonics-1, self.n_harmonics, requires_grad=False, dtype=torch.long).cuda()
+        self.register_buffer('harmonics', torch.linspace(0, self.n_harmonics-1, self.n_harmonics, dtype=torch.long), persistent=False)
 
     def forward(self, x):
         # (B, E + label)
@@ -38,6 +54,132 @@ class QueryGenerator(nn.Module):
         x = self.model(x)
         return x
 
+class FourierBasis(nn.Module):
+    def __init__(self, args):
+        super(FourierBasis, self).__init__()
+        self.lower_bound, self.upper_bound, self.skip_step = args.lower_bound, args.upper_bound, args.skip_step
+        self.cache_size = getattr(args, 'basis_cache_size', 8)
+        self.cache = OrderedDict()
+        # dense renders of a shared grid: 'direct' products, 'fft' or 'auto' to pick the cheaper one by H and S
+        self.engine = getattr(args, 'fourier_engine', 'auto')
+
+        freqs = harmonic_frequencies(self.lower_bound, self.upper_bound, self.skip_step)
+        self.register_buffer('freqs', torch.tensor(freqs, dtype=torch.float), persistent=False)
+
+    def basis(self, grid):
+        # grid (..., S) -> (..., S, 2H), cos columns first then sin columns
+        phase = grid.unsqueeze(-1) * (2 * math.pi * self.freqs.to(grid.dtype))
+        return torch.cat((torch.cos(phase), torch.sin(phase)), dim=-1)
+
+    def cached(self, kind, grid, build):
+        # LRU over time grids, keyed on the grid tensor itself, holding a reference keeps its storage from being reused
+        key = (kind, grid.data_ptr(), grid._version, tuple(grid.shape), grid.dtype, grid.device,
+               self.lower_bound, self.upper_bound, self.skip_step)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key][1]
+
+        with torch.no_grad():
+            value = build(grid)
+        self.cache[key] = (grid, value)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return value
+
+    def cached_basis(self, grid):
+        if grid.requires_grad:
+            return self.basis(grid)
+        return self.cached('basis', grid, self.basis)
+
+    def fft_plan(self, grid):
+        # grid (S) -> (M, bins (H), shift (H, 3), t0, dt) when the grid is regular, t_j = t0 + j dt, and every f dt is a
+        # multiple of 1/M, then exp(2 pi i f t_j) = exp(2 pi i f t0) exp(2 pi i bin_f j / M) with bin_f = f dt M mod M
+        # dt is the rational step the FFT evaluates, None when the grid does not qualify
+        S = grid.size(0)
+        if S < 2:
+            return None
+        t = grid.detach().double().cpu()
+        t0, dt = t[0].item(), (t[-1] - t[0]).item() / (S - 1)
+        # deviations up to the rounding of the grid dtype are accepted, the FFT evaluates the exact lattice
+        tolerance = max(1e-4 * dt, 8 * torch.finfo(grid.dtype).eps * t.abs().max().item())
+        if dt <= 0 or (t - t0 - dt * torch.arange(S, dtype=torch.float64)).abs().max().item() > tolerance:
+            return None
+
+        step = Fraction(dt).limit_denominator(10 ** 6)
+        freqs = [Fraction(f).limit_denominator(1000) for f in self.freqs.tolist()]
+        if abs(float(step) - dt) > 1e-6 * dt or any(abs(float(f) - g) > 1e-6 for f, g in zip(freqs, self.freqs.tolist())):
+            return None
+        M = math.lcm(*[(f * step).denominator for f in freqs])
+        if M > 2 ** 22:
+            return None
+
+        # only the real part is kept, so a bin above M / 2 is folded onto M - bin with the conjugate coefficient,
+        # and irfft doubles every bin but the first and the Nyquist one
+        bins = [int(f * step * M) % M for f in freqs]
+        conj = torch.tensor([-1. if m > M // 2 else 1. for m in bins], dtype=torch.float64)
+        bins = [min(m, M - m) for m in bins]
+        weight = torch.tensor([1. if m == 0 or 2 * m == M else 0.5 for m in bins], dtype=torch.float64) * M
+        phase = 2 * math.pi * t0 * self.freqs.double().cpu()
+        shift = torch.stack((torch.cos(phase) * weight, torch.sin(phase) * weight, conj), dim=-1)
+        return M, torch.tensor(bins, device=grid.device), shift.to(grid.dtype).to(grid.device), t0, float(step)
+
+    def use_fft(self, plan, S):
+        # direct products cost 2H * S against a cached basis, the FFT about 12 M log2 M plus a fixed spectrum overhead,
+        # measured on CPU, e.g. S = 1000 switches at H ~ 170 on a period 1000 grid and at H ~ 750 on linspace(0, 1, 1000)
+        if self.engine == 'direct' or plan is None:
+            return False
+        if self.engine == 'fft':
+            return True
+        return 2 * self.freqs.size(0) * S > 12 * fft_cost(plan[0]) + 2 ** 18
+
+    def fft_render(self, coeffs, plan, S):
+        # coeffs (..., B, H, 2) as (sin, cos) -> (..., B, S) on the planned grid
+        M, bins, shift = plan[:3]
+        # index_add and complex spectra need matching full-precision inputs, bf16 coefficients (autocast) are upcast
+        dtype = coeffs.dtype
+        coeffs = coeffs.to(torch.promote_types(dtype, torch.float32))
+        a, b = coeffs[..., 1], coeffs[..., 0]  # cos, sin (..., B, H)
+        shift = shift.to(a.dtype)
+        cos, sin, conj = shift[:, 0], shift[:, 1], shift[:, 2]
+        # (a - i b) exp(i 2 pi f t0) summed into bin_f, then y_j = Re(sum_k X_k exp(2 pi i k j / M))
+        shape = (*a.shape[:-1], M // 2 + 1)
+        real = torch.zeros(shape, dtype=a.dtype, device=a.device).index_add(-1, bins, a * cos + b * sin)
+        imag = torch.zeros(shape, dtype=a.dtype, device=a.device).index_add(-1, bins, (a * sin - b * cos) * conj)
+        signal = torch.fft.irfft(torch.complex(real, imag), n=M)  # (..., B, M)
+
+        # the series has period M on the grid
+        if S > M:
+            signal = signal.repeat(*[1] * (signal.dim() - 1), -(-S // M))
+        return signal[..., :S].to(dtype)
+
+    def forward(self, target_x, coeffs, index=None):
+        # target_x (B, S, 1) per sample or (S, 1) shared grid,  coeffs (..., B, H, 2) as (sin, cos)
+        # index (B, N) evaluates only the queried positions of the grid
+        # leading dims of coeffs (e.g. K latent samples) share the basis, the output is then (..., B, S)
+        weights = torch.cat((coeffs[..., 1], coeffs[..., 0]), dim=-1)  # (..., B, 2H)
+
+        if target_x.dim() == 2:
+            grid = target_x.squeeze(-1)
+            if index is None and self.engine != 'direct' and not grid.requires_grad:
+                plan = self.cached('fft', grid, self.fft_plan)
+                if plan is None and self.engine == 'fft':
+                    raise ValueError('the fft engine needs a regular grid whose step, times every harmonic frequency, is a rational number')
+                if self.use_fft(plan, grid.size(0)):
+                    return self.fft_render(coeffs, plan, grid.size(0))  # (..., B, S)
+
+            basis = self.cached_basis(grid)  # (S, 2H)
+            if index is None:
+                return torch.matmul(weights, basis.t())  # (B, S)
+            basis = basis[index]  # (B, N, 2H)
+        else:
+            target_x = target_x.squeeze(-1)
+            if index is not None:
+                target_x = torch.gather(target_x, 1, index)
+            basis = self.basis(target_x)  # (B, N, 2H)
+
+        return torch.matmul(basis, weights.unsqueeze(-1)).squeeze(-1)  # (..., B, N)
+
+
 class ConditionalFNP(nn.Module):
     def __init__(self, args):
         super(ConditionalFNP, self).__init__()
@@ -47,27 +189,14 @@ class ConditionalFNP(nn.Module):
 
         # harmonic embedding
         self.coeff_generator = QueryGenerator(args)
+        self.basis = FourierBasis(args)
 
-    def forward(self, target_x, z, x):
-        # target_x (B, S, 1)  r (B, E)
+    def forward(self, target_x, z, x, index=None):
+        # target_x (B, S, 1) or shared (S, 1)  r (B, E)  index (B, N)
 
         coeffs = self.coeff_generator(z)
         self.coeffs = coeffs
-        sin_coeffs = coeffs[:, :, 0]
-        cos_coeffs = coeffs[:, :, 1]
-
-        # make cos / sin matrix
-        cos_x = torch.cos(target_x * self.lower_bound * 2 * math.pi)
-        sin_x = torch.sin(target_x * self.lower_bound * 2 * math.pi)
-        for i in range(int(self.lower_bound + self.skip_step), int(self.upper_bound + self.skip_step),
-                       int(self.skip_step)):
-            cos_x = torch.cat((cos_x, torch.cos(target_x * 2 * i * math.pi)), dim=-1)  # (B, S, H)
-            sin_x = torch.cat((sin_x, torch.sin(target_x * 2 * i * math.pi)), dim=-1)  # (B, S, H)
-
-        cos_x = torch.mul(cos_x, cos_coeffs.unsqueeze(1))
-        sin_x = torch.mul(sin_x, sin_coeffs.unsqueeze(1))
-
-        cos_x = cos_x.sum(-1)
-        sin_x = sin_x.sum(-1)
-        periodic_signal = (cos_x + sin_x)  # (B, S)
-        return periodic_signal
\ No newline at end of file
+
+        periodic_signal = self.basis(target_x, coeffs, index)  # (B, S) or (B, N)
+        return periodic_signal
+
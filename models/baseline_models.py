@@ -1,7 +1,10 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-from torchdiffeq import odeint
+import math
+from collections import OrderedDict
+from torchdiffeq import odeint, odeint_adjoint
 
 
 
@@ -21,7 +24,7 @@ class GRUDecoder(nn.Module):
     def forward(self, target_x, memory, x):
         # target_x = (B, S, 1),  memory = (B, E), x = (B, S, 1)
         B = target_x.size(0)
-        x = torch.cat((torch.ones(B, 1, 1).cuda(), x), dim=1)   # (B, S+1, 1)
+        x = torch.cat((torch.ones(B, 1, 1, device=x.device), x), dim=1)   # (B, S+1, 1)
         x = self.input_embedding(x)  # (B, E)
         memory = self.init_hidden_embedding(memory)
         memory = torch.broadcast_to(memory.unsqueeze(0), (self.decoder_layers, B, self.decoder_hidden_dim)) # (num_layers, B, hidden)
@@ -32,20 +35,20 @@ class GRUDecoder(nn.Module):
 
     def auto_regressive(self, target_x, memory):
         # target_x = (B, S, 1)  z = (B, E)
+        # carries the GRU hidden state and feeds one token per step, O(S) instead of rerunning the prefix
         B, S, _ = target_x.size()
-        xx = self.input_embedding(torch.ones(B, 1, 1).cuda())
-        memory = self.init_hidden_embedding(memory)
-        memory = torch.broadcast_to(memory.unsqueeze(0), (self.decoder_layers, B, self.decoder_hidden_dim))
-        memory = memory.contiguous()
+        xx = self.input_embedding(torch.ones(B, 1, 1, device=target_x.device))  # (B, 1, E)
+        hidden = self.init_hidden_embedding(memory)
+        hidden = torch.broadcast_to(hidden.unsqueeze(0), (self.decoder_layers, B, self.decoder_hidden_dim))
+        hidden = hidden.contiguous()
 
         outputs = []
-        for i in range(500):
-            output, _ = self.GRU(xx, memory)
-            output = self.output_fc(output)[:, -1, :]
+        for i in range(S):
+            output, hidden = self.GRU(xx, hidden)
+            output = self.output_fc(output)[:, -1, :]  # (B, 1)
             outputs.append(output)
-            xx = torch.cat((xx, self.input_embedding(output).unsqueeze(1)), dim=1)
-        outputs = torch.stack(outputs)
-        outputs = outputs.permute(1, 0, 2)
+            xx = self.input_embedding(output).unsqueeze(1)
+        outputs = torch.stack(outputs, dim=1)  # (B, S, 1)
         return outputs
 
 
@@ -100,12 +103,35 @@ class ODEDecoder(nn.Module):
         self.odenet = ODEFunc(args.latent_dimension, args.decoder_layers)
         self.fc2 = nn.Linear(2*args.latent_dimension, 1)
 
-    def forward(self, target_x, z, x):
-        # target_x = (B, S, 1)  z = (B, E)
+        # solver configuration, the defaults reproduce the original fixed-step rk4
+        self.method = getattr(args, 'ode_method', 'rk4')
+        self.rtol = getattr(args, 'ode_rtol', 1e-7)
+        self.atol = getattr(args, 'ode_atol', 1e-9)
+        self.step_size = getattr(args, 'ode_step_size', None)
+        self.adjoint = getattr(args, 'ode_adjoint', False)
+
+    def solve(self, z, t):
+        # z (B, E)  t (U) increasing -> (U, B, E)
+        options = {'step_size': self.step_size} if self.step_size is not None else None
+        # the integrator state stays in fp32 under autocast, reduced precision compounds over the solver steps
+        with torch.autocast(device_type=z.device.type, enabled=False):
+            z, t = z.float(), t.float()
+            if self.adjoint:
+                # memory stays constant in the number of solver steps, gradients come from solving the adjoint backwards
+                return odeint_adjoint(self.odenet, z, t, rtol=self.rtol, atol=self.atol, method=self.method, options=options)
+            return odeint(self.odenet, z, t, rtol=self.rtol, atol=self.atol, method=self.method, options=options)
+
+    def forward(self, target_x, z, x, t0=None):
+        # target_x = (B, S, 1) query times per sample  z = (B, E)  t0 integration start, defaults to the earliest query time
+        times = target_x.squeeze(-1)  # (B, S)
         z = self.fc1(z)
-        pred_y = odeint(self.odenet, z, target_x[0].squeeze(-1), method='rk4')
-        pred_y = self.fc2(pred_y).permute(1, 0, 2).squeeze(-1)
-        return pred_y
+
+        # one solve over the union of every sample's query times, gathered back per sample
+        steps = times.flatten() if t0 is None else torch.cat((t0.view(1), times.flatten()))
+        steps = torch.unique(steps)  # (U)
+        pred_y = self.solve(z, steps)  # (U, B, E)
+        pred_y = self.fc2(pred_y).permute(1, 0, 2).squeeze(-1)  # (B, U)
+        return torch.gather(pred_y, 1, torch.searchsorted(steps, times.contiguous()))
 
 class TransformerDecoder(nn.Module):
     def __init__(self, args):
@@ -120,6 +146,9 @@ class TransformerDecoder(nn.Module):
                                                    dropout = args.dropout)
         self.model = nn.TransformerEncoder(decoder_layer, num_layers=args.decoder_layers)
         self.output_fc = nn.Linear(128, 1, bias=False)
+        # LRU of the last mask_cache_size causal masks, each one is (S+1)^2 floats
+        self.mask_cache = OrderedDict()
+        self.mask_cache_size = 4
 
     def forward(self, target_x, r, x):
         # x (B, S, 1)  target_x (B, S, 1)  r (B, E)
@@ -129,39 +158,83 @@ class TransformerDecoder(nn.Module):
         x = self.embedding(x)  # (B, S, E)
         x = torch.cat((r, x), dim=1)  # (B, S+1, E)
 
-        target_x = torch.cat((torch.zeros(B, 1, 1).cuda(), target_x), dim=1)  # (B, S+1, 1)
+        target_x = torch.cat((torch.zeros(B, 1, 1, device=target_x.device), target_x), dim=1)  # (B, S+1, 1)
         target_x = self.pos_embedding(target_x)  # (B, S+1, E)
         x = x + target_x  # (B, S+1, E)
         x = self.dropout(x)
 
         x = x.permute(1, 0, 2)  # (S+1, B, E)
-        mask = self.generate_square_subsequent_mask(x.size(0))
+        mask = self.generate_square_subsequent_mask(x.size(0), x.device)
         output = self.model(src=x, mask=mask).permute(1, 0, 2)  # (B, S+1, E)
         output = self.output_fc(output).squeeze(-1)
         return output[:, :-1]
 
-    def generate_square_subsequent_mask(self, sz):
-        mask = (torch.triu(torch.ones((sz, sz))) == 1).transpose(0, 1)
+    def generate_square_subsequent_mask(self, sz, device):
+        # masks only depend on (size, device) and are reused across calls
+        key = (sz, device)
+        if key in self.mask_cache:
+            self.mask_cache.move_to_end(key)
+            return self.mask_cache[key]
+
+        mask = (torch.triu(torch.ones((sz, sz), device=device)) == 1).transpose(0, 1)
         mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
-        return mask.cuda()
+        self.mask_cache[key] = mask
+        if len(self.mask_cache) > self.mask_cache_size:
+            self.mask_cache.popitem(last=False)
+        return mask
+
+    def layer_step(self, layer, x, cache, i):
+        # x (1, B, E) newest position only,  cache {'k', 'v'} (B, nhead, S, d) holds the keys / values of positions < i
+        attn = layer.self_attn
+        B, E = x.size(1), x.size(2)
+        H = attn.num_heads
+        d = E // H
+
+        h = layer.norm1(x) if layer.norm_first else x
+        q, k, v = F.linear(h[0], attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)  # (B, E)
+        cache['k'][:, :, i] = k.view(B, H, d)
+        cache['v'][:, :, i] = v.view(B, H, d)
+
+        # causality comes from only attending to the filled part of the cache
+        score = torch.matmul(q.view(B, H, 1, d), cache['k'][:, :, :i+1].transpose(-1, -2)) / math.sqrt(d)  # (B, H, 1, i+1)
+        score = F.dropout(torch.softmax(score, dim=-1), p=attn.dropout, training=self.training)
+        h = torch.matmul(score, cache['v'][:, :, :i+1]).view(1, B, E)
+        h = attn.out_proj(h)
+
+        if layer.norm_first:
+            x = x + layer.dropout1(h)
+            x = x + layer.dropout2(layer.linear2(layer.dropout(layer.activation(layer.linear1(layer.norm2(x))))))
+        else:
+            x = layer.norm1(x + layer.dropout1(h))
+            x = layer.norm2(x + layer.dropout2(layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))))
+        return x
 
     def auto_regressive(self, r, target_x):
         # r (B, E)  target_x (B, S, 1)
+        # every layer caches its keys / values, each step only computes the newest position
         with torch.no_grad():
             B = r.size(0)
             S = target_x.size(1)
 
-            r = self.label_embedding(r).unsqueeze(1)   # (B, 1, E)
-            target_x = torch.cat((torch.zeros(B, 1, 1).cuda(), target_x), dim=1)  # (B, S+1, 1)
+            r = self.label_embedding(r).unsqueeze(0)   # (1, B, E)
+            target_x = torch.cat((torch.zeros(B, 1, 1, device=target_x.device), target_x), dim=1)  # (B, S+1, 1)
+            dec_span = self.pos_embedding(target_x).permute(1, 0, 2)  # (S+1, B, E)
 
-            dec_x = r.permute(1, 0, 2)  # (1, B, E)
-            outputs = []
+            E = r.size(-1)
+            caches = []
+            for layer in self.model.layers:
+                H = layer.self_attn.num_heads
+                caches.append({'k': r.new_empty(B, H, S, E // H), 'v': r.new_empty(B, H, S, E // H)})
+
+            dec_x = r
+            outputs = r.new_empty(B, S)
             for i in range(S):
-                mask = self.generate_square_subsequent_mask(dec_x.size(0))
-                dec_span = self.pos_embedding(target_x[:, :i+1, :]).permute(1, 0, 2) # (i, B, E)
-                x = dec_x + dec_span
-                output = self.model(src=x, mask=mask)  # (i, B, E)
-                output = self.output_fc(output)[-1]  # (B, 1)
-                outputs.append(output)
-                dec_x = torch.cat((dec_x, self.embedding(output.unsqueeze(0))), dim=0)
-        return outputs
+                x = dec_x + dec_span[i:i+1]  # (1, B, E)
+                for layer, cache in zip(self.model.layers, caches):
+                    x = self.layer_step(layer, x, cache, i)
+                if self.model.norm is not None:
+                    x = self.model.norm(x)
+                output = self.output_fc(x)[-1]  # (B, 1)
+                outputs[:, i] = output.squeeze(-1)
+                dec_x = self.embedding(output.unsqueeze(0))  # (1, B, E)
+        return outputs  # (B, S)
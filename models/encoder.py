@@ -19,13 +19,16 @@ class ConvEncoder(nn.Module):
         layers.append(nn.SiLU())
         layers.append(nn.Conv1d(in_channels=args.encoder_hidden_dim, out_channels=args.latent_dimension, kernel_size=3, stride=1, dilation=1))
 
+        # (kernel, stride) of every layer that shortens the sequence, for the valid lengths of padded inputs
+        self.windows = [(layer.kernel_size[0], layer.stride[0]) if isinstance(layer, nn.Conv1d) else (layer.kernel_size, layer.stride)
+                        for layer in layers if isinstance(layer, (nn.Conv1d, nn.MaxPool1d))]
         self.model = nn.Sequential(*layers)
         self.glob_pool = nn.AdaptiveAvgPool1d(1)
         self.latent_mu = nn.Linear(args.latent_dimension, args.latent_dimension)
         self.latent_sigma = nn.Linear(args.latent_dimension, args.latent_dimension)
 
-    def forward(self, x, label, span):
-        # x (B, S, 1)  label (B, num_label)  span (B, S)
+    def forward(self, x, label, span, lengths=None):
+        # x (B, S, 1)  label (B, num_label)  span (B, S)  lengths (B) valid observations of right-padded inputs
         B, S, _ = x.size()
 
         # span concat
@@ -34,14 +37,26 @@ class ConvEncoder(nn.Module):
 
         input_pairs = torch.cat((x, span, label), dim=-1)  # (B, S, 1+num_label)
         output = self.model(input_pairs.permute(0, 2, 1))  # (B, E, S)
-        output = self.glob_pool(output).squeeze(-1)  # (B, E)
+        if lengths is None:
+            output = self.glob_pool(output).squeeze(-1)  # (B, E)
+        else:
+            # unpadded convolutions and pools only see padding past the valid output positions, which are masked out
+            valid = self.output_lengths(lengths).clamp(min=1)  # (B)
+            mask = (torch.arange(output.size(-1), device=output.device) < valid.unsqueeze(-1)).to(output.dtype)  # (B, S')
+            output = (output * mask.unsqueeze(1)).sum(-1) / valid.unsqueeze(-1).to(output.dtype)  # (B, E)
         z0, z_dist = self.reparameterization(output)
         return output, z0, z_dist
 
+    def output_lengths(self, lengths):
+        for kernel, stride in self.windows:
+            lengths = torch.div(lengths - kernel, stride, rounding_mode='floor') + 1
+        return lengths
+
     def reparameterization(self, z):
         mean = self.latent_mu(z)
         std = self.latent_sigma(z)
         z_dist = Normal(mean, nn.functional.softplus(std))
-        z0 = z_dist.rsample()
+        # same draw as z_dist.rsample(), but out of place so replicas under vmap get independent noise
+        z0 = z_dist.loc + z_dist.scale * torch.randn_like(z_dist.loc)
         return z0, z_dist
 
@@ -0,0 +1,53 @@
+import torch
+import torch.nn as nn
+from torch.func import stack_module_state, functional_call, vmap
+
+from models.latentmodel import ConditionalQueryFNP
+
+
+class ModelEnsemble(nn.Module):
+    """
+    K replicas of ConditionalQueryFNP with their parameters stacked along a leading replica dimension,
+    evaluated for the same batch in one vmapped call. Every replica draws its own latent and dropout noise.
+    """
+    # torchdiffeq updates its state in place and nn.GRU has no batching rule, neither runs under vmap
+    supported_decoders = ['Fourier', 'NP', 'Transformer']
+
+    def __init__(self, args, n_replicas, seed=0):
+        super(ModelEnsemble, self).__init__()
+        if args.decoder not in self.supported_decoders:
+            raise NotImplementedError(f'the {args.decoder} decoder can not be vectorized, ensembles support {self.supported_decoders}')
+        self.n_replicas = n_replicas
+
+        # replica k is initialized from seed + k
+        replicas = []
+        for k in range(n_replicas):
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(seed + k)
+                replicas.append(ConditionalQueryFNP(args))
+        params, _ = stack_module_state(replicas)
+
+        # the first replica only provides the structure and the non-persistent buffers, it is kept out of the module tree
+        # so parameters() and state_dict() only hold the stacked (K, ...) tensors
+        object.__setattr__(self, 'base', replicas[0].requires_grad_(False))
+        self.names = list(params.keys())
+        self.stacked = nn.ParameterList([nn.Parameter(params[name]) for name in self.names])
+
+    def train(self, mode=True):
+        self.base.train(mode)
+        return super(ModelEnsemble, self).train(mode)
+
+    def _apply(self, fn, recurse=True):
+        # .to() / .cuda() also move the buffers of the base module
+        self.base._apply(fn, recurse)
+        return super(ModelEnsemble, self)._apply(fn, recurse)
+
+    def forward(self, t, x, label, index, obs_lengths=None):
+        # same inputs as ConditionalQueryFNP.forward, returns the (K) mse and kl losses
+        def replica(params, t, x, label, index, obs_lengths):
+            return functional_call(self.base, dict(zip(self.names, params)), (t, x, label, index, obs_lengths))
+        return vmap(replica, in_dims=(0, None, None, None, None, None), randomness='different')(tuple(self.stacked), t, x, label, index, obs_lengths)
+
+    def replica_state_dict(self, k):
+        # a ConditionalQueryFNP state_dict of replica k, loadable by inference.engine.load_model
+        return {name: parameter[k] for name, parameter in zip(self.names, self.stacked)}
@@ -1,6 +1,9 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+import math
 
 from models.encoder import *
 from models.FourierModel import ConditionalFNP
@@ -13,6 +16,10 @@ class ConditionalQueryFNP(nn.Module):
         self.num_label = args.num_label
         self.latent_dim = args.latent_dimension
         self.n_harmonics = args.n_harmonics
+        # start of the training time grid, where the ODE decoder places the latent state
+        self.time_origin = getattr(args, 'time_origin', 0.)
+        # queries decoded per tile by the pointwise (Fourier / NP) decoders, None decodes all at once
+        self.decode_tile = getattr(args, 'decode_tile', None)
 
         self.encoder = ConvEncoder(args)
 
@@ -27,22 +34,32 @@ class ConditionalQueryFNP(nn.Module):
         elif args.decoder == 'RNN':
             self.decoder = GRUDecoder(args)
 
-        self.prior = Normal(torch.zeros([self.latent_dim]).cuda(), torch.ones([self.latent_dim]).cuda())
+        self.register_buffer('prior_mean', torch.zeros([self.latent_dim]), persistent=False)
+        self.register_buffer('prior_std', torch.ones([self.latent_dim]), persistent=False)
+
+    @property
+    def prior(self):
+        return Normal(self.prior_mean, self.prior_std)
 
-    def forward(self, t, x, label, index):
-        # t (B, S)  x (B, S, 1)  label (B)
+    def forward(self, t, x, label, index, obs_lengths=None):
+        # t (B, S) or shared (S)  x (B, S, 1)  label (B)
+        # obs_lengths (B) valid leading entries of a right-padded index, None when every entry is valid
         B = x.size(0)
 
+        # a shared time grid is broadcast instead of copied, the Fourier decoder caches its basis
+        grid = t.unsqueeze(-1) if t.dim() == 1 else None
+        if grid is not None:
+            t = t.expand(B, t.size(0))
+
         # label information
-        label_embed = torch.zeros(B, self.num_label).cuda()
-        label_embed[range(B), label] = 1
+        label_embed = self.label_embedding(label)
 
         # select irregulary sampled
         dummy = index.unsqueeze(-1)
         input_x = torch.gather(x, 1, dummy)
         input_t = torch.gather(t, 1, index)
 
-        memory, z, z_dist = self.encoder(input_x, label_embed, span=input_t)
+        memory, z, z_dist = self.encoder(input_x, label_embed, span=input_t, lengths=obs_lengths)
         # memory, z, qz0_mean, qz0_logvar = self.encoder(x, 0, span=t)
         kl_loss = torch.distributions.kl.kl_divergence(z_dist, self.prior).mean(-1).mean(0)
 
@@ -51,10 +68,155 @@ class ConditionalQueryFNP(nn.Module):
         # concat label information
         z = torch.cat((z, label_embed), dim=-1)  # (B, E+num_label)
 
-        decoded_traj = self.decoder(t.unsqueeze(-1), z, x)
-        x = x.squeeze(-1)
+        decoded_traj = self.decode(t, z, x, index, grid)  # (B, N)
         # mse_loss = nn.MSELoss(reduction='sum')(decoded_traj, x)
         # mse_loss = mse_loss / B
-        mse_loss = nn.MSELoss()(torch.gather(decoded_traj, 1, index), torch.gather(x, 1, index))
+        if obs_lengths is None:
+            mse_loss = nn.MSELoss()(decoded_traj, input_x.squeeze(-1))
+        else:
+            mask = (torch.arange(index.size(1), device=index.device) < obs_lengths.unsqueeze(-1)).to(decoded_traj.dtype)  # (B, N)
+            mse_loss = ((decoded_traj - input_x.squeeze(-1)) ** 2 * mask).sum() / mask.sum()
         return mse_loss, kl_loss
-        # return mse_loss, 0
\ No newline at end of file
+        # return mse_loss, 0
+
+    def accelerate(self, mode):
+        # mode 'compile' compiles the encoder and decoder, 'script' scripts their pure nn.Sequential stacks,
+        # both modify the model in place and keep the state_dict keys
+        if mode == 'compile':
+            self.encoder.compile()
+            self.decoder.compile()
+        elif mode == 'script':
+            self.encoder.model = torch.jit.script(self.encoder.model)
+            if isinstance(self.decoder, ConditionalFNP):
+                self.decoder.coeff_generator.model = torch.jit.script(self.decoder.coeff_generator.model)
+            elif isinstance(self.decoder, NeuralProcess):
+                self.decoder.model = torch.jit.script(self.decoder.model)
+            elif isinstance(self.decoder, ODEDecoder):
+                self.decoder.odenet.net = torch.jit.script(self.decoder.odenet.net)
+            # the Transformer / RNN decoders stay eager, their step-wise generation reaches into the layers
+        return self
+
+    def label_embedding(self, label):
+        # label (B) -> one-hot (B, num_label)
+        label_embed = torch.zeros(label.size(0), self.num_label, device=label.device)
+        label_embed[range(label.size(0)), label] = 1
+        return label_embed
+
+    def encode(self, obs_t, obs_x, label, sample=False, obs_lengths=None):
+        # obs_t (B, N)  obs_x (B, N, 1) irregular observations  label (B)  obs_lengths (B) of right-padded observations
+        # returns the posterior mean (or a sample) concatenated with the label (B, E+num_label) and the posterior
+        label_embed = self.label_embedding(label)
+        memory, z, z_dist = self.encoder(obs_x, label_embed, span=obs_t, lengths=obs_lengths)
+        if not sample:
+            z = z_dist.mean
+        return torch.cat((z, label_embed), dim=-1), z_dist
+
+    def reconstruct(self, obs_t, obs_x, label, query_t, sample=False, t0=None, obs_lengths=None):
+        # obs_t (B, N)  obs_x (B, N, 1) irregular observations  label (B)  query_t (B, Q) or shared (Q) times to decode
+        # decodes from the posterior mean unless sample, returns (B, Q)
+        z, _ = self.encode(obs_t, obs_x, label, sample, obs_lengths)
+        return self.decode_latent(z, query_t, t0)
+
+    def decode_latent(self, z, query_t, t0=None):
+        # z (B, E+num_label) decoded at query_t (B, Q) or shared (Q)
+        # t0 is the time of the ODE latent state, the training grid origin unless given
+        if query_t.dim() == 1:
+            # a shared dense grid, the Fourier decoder renders it from its cached basis or by FFT
+            if isinstance(self.decoder, ConditionalFNP):
+                return self.decoder(query_t.unsqueeze(-1), z, None)
+            query_t = query_t.expand(z.size(0), -1)
+
+        if isinstance(self.decoder, TransformerDecoder):
+            return self.decoder.auto_regressive(z, query_t.unsqueeze(-1))
+        if isinstance(self.decoder, GRUDecoder):
+            return self.decoder.auto_regressive(query_t.unsqueeze(-1), z).squeeze(-1)
+        if isinstance(self.decoder, ODEDecoder):
+            t0 = torch.as_tensor(self.time_origin if t0 is None else t0, dtype=query_t.dtype, device=query_t.device)
+            assert (query_t >= t0).all(), 'the ODE decoder only integrates forward from t0'
+            return self.decoder(query_t.unsqueeze(-1), z, None, t0=t0)
+        return self.decode(query_t, z, None)
+
+    def predictive(self, obs_t, obs_x, label, query_t, n_samples=32, quantiles=(0.05, 0.5, 0.95), noise_std=None, obs_lengths=None, t0=None):
+        """
+        Monte Carlo predictive distribution from K = n_samples posterior draws per series, encoded once and decoded
+        as one (K*B) batch, the Fourier decoder evaluates its basis once for all K coefficient sets.
+        obs_t (B, N)  obs_x (B, N, 1)  label (B)  query_t (B, Q) or shared (Q)
+        Returns a dict of the 'mean' and 'std' (B, Q), the 'quantiles' (P, B, Q) and 'samples' (K, B, Q) at query_t,
+        and the importance-weighted 'log_likelihood' (B) of the observations under N(decoded, noise_std^2),
+        noise_std defaults to the per-series RMS residual of the predictive mean, t0 as in decode_latent.
+        """
+        K, B, N = n_samples, obs_x.size(0), obs_x.size(1)
+        label_embed = self.label_embedding(label)
+        _, _, z_dist = self.encoder(obs_x, label_embed, span=obs_t, lengths=obs_lengths)
+        z = z_dist.rsample((K,))  # (K, B, E)
+        latent = torch.cat((z, label_embed.expand(K, B, -1)), dim=-1)  # (K, B, E+num_label)
+
+        if isinstance(self.decoder, ConditionalFNP):
+            coeffs = self.decoder.coeff_generator(latent.flatten(0, 1)).unflatten(0, (K, B))  # (K, B, H, 2)
+            obs_pred = self.decoder.basis(obs_t.unsqueeze(-1), coeffs)  # (K, B, N)
+            samples = self.decoder.basis(query_t.unsqueeze(-1), coeffs)  # (K, B, Q)
+        else:
+            if query_t.dim() == 1:
+                query_t = query_t.expand(B, -1)
+            repeat = lambda t: t.expand(K, *t.shape).flatten(0, 1)  # (B, .) -> (K*B, .)
+            obs_pred = self.decode_latent(latent.flatten(0, 1), repeat(obs_t), t0).unflatten(0, (K, B))
+            samples = self.decode_latent(latent.flatten(0, 1), repeat(query_t), t0).unflatten(0, (K, B))
+
+        obs_x = obs_x.squeeze(-1)
+        if obs_lengths is None:
+            mask = torch.ones_like(obs_x)
+        else:
+            mask = (torch.arange(N, device=obs_x.device) < obs_lengths.unsqueeze(-1)).to(obs_x.dtype)  # (B, N)
+        if noise_std is None:
+            noise_std = ((((obs_pred.mean(0) - obs_x) ** 2) * mask).sum(-1) / mask.sum(-1)).sqrt().clamp_min(1e-3)  # (B)
+        noise_std = torch.as_tensor(noise_std, dtype=obs_pred.dtype, device=obs_pred.device).reshape(-1, 1)
+
+        # log w_k = log p(x | z_k) + log p(z_k) - log q(z_k | x)
+        log_px = (Normal(obs_pred, noise_std).log_prob(obs_x) * mask).sum(-1)  # (K, B)
+        log_w = log_px + self.prior.log_prob(z).sum(-1) - z_dist.log_prob(z).sum(-1)
+        probs = torch.as_tensor(quantiles, dtype=samples.dtype, device=samples.device)
+        return {'mean': samples.mean(0),
+                'std': samples.std(0),
+                'quantiles': torch.quantile(samples, probs, dim=0),
+                'samples': samples,
+                'log_likelihood': torch.logsumexp(log_w, 0) - math.log(K)}
+
+    def decode(self, t, z, x, index=None, grid=None):
+        # t (B, S)  z (B, E+num_label)  x (B, S, 1)  index (B, N) query positions, None decodes the dense trajectory
+        # grid (S, 1) shared time grid, lets the Fourier decoder reuse its cached basis
+        if self.decode_tile and isinstance(self.decoder, (ConditionalFNP, NeuralProcess)):
+            return self.tiled_decode(t, z, x, index, grid)
+        return self.decode_queries(t, z, x, index, grid)
+
+    def tiled_decode(self, t, z, x, index=None, grid=None):
+        # Fourier / NP outputs are pointwise in time, so the queries are decoded decode_tile at a time and,
+        # with autograd on, recomputed in backward: only one (B, tile, .) slice of decoder activations is alive
+        if index is None:
+            index = torch.arange(t.size(1), device=t.device).expand(t.size(0), t.size(1))
+        outputs = []
+        for start in range(0, index.size(1), self.decode_tile):
+            tile = index[:, start:start+self.decode_tile]
+            if torch.is_grad_enabled():
+                outputs.append(checkpoint(self.decode_queries, t, z, x, tile, grid, use_reentrant=False))
+            else:
+                outputs.append(self.decode_queries(t, z, x, tile, grid))
+        return torch.cat(outputs, dim=1)  # (B, N)
+
+    def decode_queries(self, t, z, x, index=None, grid=None):
+        if isinstance(self.decoder, ConditionalFNP):
+            if grid is not None:
+                return self.decoder(grid, z, x, index)
+            return self.decoder(t.unsqueeze(-1), z, x, index)
+
+        if index is None:
+            return self.decoder(t.unsqueeze(-1), z, x)
+
+        if isinstance(self.decoder, NeuralProcess):
+            return self.decoder(torch.gather(t, 1, index).unsqueeze(-1), z, x)
+
+        if isinstance(self.decoder, ODEDecoder):
+            # solved over the union of queried times, always starting from the grid origin
+            return self.decoder(torch.gather(t, 1, index).unsqueeze(-1), z, x, t0=t[:, 0].min())
+
+        # autoregressive decoders need the whole teacher-forced prefix
+        return torch.gather(self.decoder(t.unsqueeze(-1), z, x), 1, index)
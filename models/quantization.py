@@ -0,0 +1,42 @@
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+import copy
+
+from models.latentmodel import ConditionalQueryFNP
+
+
+def quantize(model, calibration=(), static_encoder=True, engine='x86'):
+    """
+    Post-training int8 copy of a ConditionalQueryFNP for CPU inference.
+    Every nn.Linear / nn.GRU is quantized dynamically (int8 weights, activations quantized per call).
+    With static_encoder the conv stack of the encoder is quantized statically through FX, its activation ranges
+    are calibrated by encoding the calibration batches, (obs_t (B, N), obs_x (B, N, 1), label (B), obs_lengths (B) or None)
+    tuples, so the zero padding of ragged batches does not enter the activation ranges.
+    """
+    torch.backends.quantized.engine = engine
+    model = copy.deepcopy(model).cpu().eval()
+
+    if static_encoder:
+        qconfig_mapping = get_default_qconfig_mapping(engine)
+        example_inputs = (torch.randn(1, 2 + model.num_label, 128),)
+        model.encoder.model = prepare_fx(model.encoder.model, qconfig_mapping, example_inputs)
+        with torch.no_grad():
+            for obs_t, obs_x, label, obs_lengths in calibration:
+                model.encode(obs_t, obs_x, label, obs_lengths=obs_lengths)
+        model.encoder.model = convert_fx(model.encoder.model)
+
+    return quantize_dynamic(model, {nn.Linear, nn.GRU}, dtype=torch.qint8)
+
+
+def quantized_model(args, quantization):
+    # the structure of a quantized artifact, its scales and int8 weights come from load_state_dict
+    return quantize(ConditionalQueryFNP(args), static_encoder=quantization['static_encoder'], engine=quantization['engine'])
+
+
+def save_quantized(model, args, path, static_encoder=True, engine='x86'):
+    torch.save({'model_state_dict': model.state_dict(),
+                'quantization': {'static_encoder': static_encoder, 'engine': engine},
+                'args': vars(args)}, path)
@@ -0,0 +1,122 @@
+import argparse
+import math
+
+import pytest
+import torch
+
+from models.FourierModel import FourierBasis, fft_cost
+from models.latentmodel import ConditionalQueryFNP
+
+
+def make_basis(lower_bound, upper_bound, skip_step, engine='fft'):
+    return FourierBasis(argparse.Namespace(lower_bound=lower_bound, upper_bound=upper_bound, skip_step=skip_step, fourier_engine=engine))
+
+
+def model_args(n_harmonics, engine='auto'):
+    return argparse.Namespace(decoder='Fourier', n_harmonics=n_harmonics, lower_bound=1, upper_bound=n_harmonics, skip_step=1,
+                              NP=False, latent_dimension=3, num_label=4, encoder_hidden_dim=32, encoder_blocks=3,
+                              decoder_layers=2, decoder_hidden_dim=32, dropout=0., dataset_type='sin', device='cpu',
+                              fourier_engine=engine)
+
+
+# (lower_bound, upper_bound, skip_step, grid) as the datasets and renders build them, float32 unless noted
+GRIDS = [
+    (1, 4, 1, torch.linspace(0, 1, 1000)),
+    (1, 300, 1, torch.linspace(0, 1, 1000)),
+    (1, 600, 1, torch.linspace(0, 1, 1000)),
+    (1, 300, 1, torch.linspace(0, 10, 5000)),
+    (1, 600, 1, torch.arange(997) / 997),
+    (1, 300, 1, torch.arange(2000) / 1000),
+    (2, 400, 2, torch.linspace(0.3, 2.3, 777)),
+    (2, 400, 2, torch.linspace(0.25, 3.25, 301)),
+    (1.5, 64.5, 1, torch.linspace(0, 2, 1000)),
+    (1, 300, 1, torch.linspace(0, 1, 100)),
+    (1, 30, 1, torch.linspace(0, 5, 20)),
+    (1, 300, 1, torch.linspace(0, 1, 1000, dtype=torch.float64)),
+]
+
+
+@pytest.mark.parametrize('lower_bound, upper_bound, skip_step, grid', GRIDS)
+def test_fft_matches_direct_on_planned_lattice(lower_bound, upper_bound, skip_step, grid):
+    # the FFT evaluates the series exactly on t0 + j dt with the plan's rational dt, compared in float64 on that lattice
+    basis = make_basis(lower_bound, upper_bound, skip_step).double()
+    plan = basis.fft_plan(grid)
+    assert plan is not None
+    M, _, _, t0, dt = plan
+    assert (M * dt * basis.freqs.double()).sub((M * dt * basis.freqs.double()).round()).abs().max() < 1e-6
+
+    lattice = t0 + dt * torch.arange(grid.size(0), dtype=torch.float64)
+    assert (lattice - grid.double()).abs().max() <= 8 * torch.finfo(grid.dtype).eps * grid.abs().max() + 1e-4 * dt
+
+    coeffs = torch.randn(8, basis.freqs.size(0), 2, dtype=torch.float64, generator=torch.Generator().manual_seed(0))
+    direct = torch.matmul(torch.cat((coeffs[..., 1], coeffs[..., 0]), dim=-1), basis.basis(lattice).t())  # (B, S)
+    fft = basis.fft_render(coeffs, basis.fft_plan(lattice), grid.size(0))
+    assert (fft - direct).abs().max() < 1e-9
+
+
+@pytest.mark.parametrize('lower_bound, upper_bound, skip_step, grid', [g for g in GRIDS if g[3].dtype == torch.float32])
+def test_fft_engine_float32(lower_bound, upper_bound, skip_step, grid):
+    # end to end through forward on the float32 grid, the direct path carries float32 phase errors of about 2 pi f eps
+    coeffs = torch.randn(8, len(make_basis(lower_bound, upper_bound, skip_step).freqs), 2, generator=torch.Generator().manual_seed(0))
+    fft = make_basis(lower_bound, upper_bound, skip_step, 'fft')(grid.unsqueeze(-1), coeffs)
+    direct = make_basis(lower_bound, upper_bound, skip_step, 'direct')(grid.unsqueeze(-1), coeffs)
+    scale = coeffs.abs().sum(dim=(-1, -2)).max()
+    tolerance = 8 * 2 * math.pi * upper_bound * grid.abs().max() * torch.finfo(torch.float32).eps
+    assert fft.dtype == torch.float32 and fft.shape == direct.shape
+    assert (fft - direct).abs().max() < tolerance * scale
+
+
+def test_fft_engine_with_sample_dims_and_gradients():
+    grid = torch.arange(1000, dtype=torch.float64) / 1000
+    coeffs = torch.randn(4, 3, 300, 2, dtype=torch.float64, requires_grad=True)
+    fft = make_basis(1, 300, 1, 'fft').double()(grid.unsqueeze(-1), coeffs)
+    direct = make_basis(1, 300, 1, 'direct').double()(grid.unsqueeze(-1), coeffs)
+    assert fft.shape == (4, 3, 1000)
+    assert (fft - direct).abs().max() < 1e-9
+
+    weights = torch.randn(4, 3, 1000, dtype=torch.float64)
+    grad_fft, = torch.autograd.grad((fft * weights).sum(), coeffs)
+    grad_direct, = torch.autograd.grad((direct * weights).sum(), coeffs)
+    assert (grad_fft - grad_direct).abs().max() < 1e-8
+
+
+def test_irregular_and_queried_grids_keep_direct_path():
+    basis = make_basis(1, 300, 1)
+    assert basis.fft_plan(torch.linspace(0, 1, 1000) ** 2) is None
+    with pytest.raises(ValueError):
+        basis((torch.linspace(0, 1, 1000) ** 2).unsqueeze(-1), torch.randn(2, 300, 2))
+
+    # indexed queries are always decoded by the direct products
+    grid, coeffs = torch.linspace(0, 1, 1000), torch.randn(2, 300, 2)
+    index = torch.randint(0, 1000, (2, 50))
+    direct = make_basis(1, 300, 1, 'direct')(grid.unsqueeze(-1), coeffs)
+    assert torch.allclose(basis(grid.unsqueeze(-1), coeffs, index), torch.gather(direct, 1, index), rtol=1e-5, atol=1e-4)
+
+
+def test_auto_selection():
+    grid = torch.arange(5000) / 5000
+    assert not make_basis(1, 4, 1, 'auto').use_fft(make_basis(1, 4, 1).fft_plan(grid), 5000)
+    assert make_basis(1, 300, 1, 'auto').use_fft(make_basis(1, 300, 1).fft_plan(grid), 5000)
+    assert not make_basis(1, 300, 1, 'direct').use_fft(make_basis(1, 300, 1).fft_plan(grid), 5000)
+    # prime sizes go through Bluestein
+    assert fft_cost(4999) > 5 * fft_cost(5000)
+
+
+def test_bf16_autocast_render():
+    torch.manual_seed(0)
+    model = ConditionalQueryFNP(model_args(300)).eval()
+    z = torch.randn(4, 3 + 4)
+    query_t = torch.arange(1000) / 1000.
+    assert model.decoder.basis.use_fft(model.decoder.basis.fft_plan(query_t), 1000)
+
+    with torch.no_grad():
+        reference = model.decode_latent(z, query_t)
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            output = model.decode_latent(z, query_t)
+        model.decoder.basis.engine = 'direct'
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            direct = model.decode_latent(z, query_t)
+
+    assert output.dtype == direct.dtype and output.shape == (4, 1000)
+    # the bf16 coefficients are the only low precision step of the FFT path
+    assert (output.float() - reference).abs().max() < 0.05 * reference.abs().max()
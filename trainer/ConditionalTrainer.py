@@ -1,37 +1,73 @@
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DistributedSampler
 
 import os
-import wandb
+import logging
+import copy
 import time
+import numpy as np
 from datetime import datetime
 
 
-from datasets.cond_dataset import get_dataloader
+from datasets.cond_dataset import get_dataloader, LengthBucketBatchSampler
 from models.latentmodel import ConditionalQueryFNP
-from utils.model_utils import count_parameters, EarlyStopping
-from utils.trainer_utils import log
+from models.ensemble import ModelEnsemble
+from utils.model_utils import count_parameters, EarlyStopping, autocast, fast_path_error
+from utils.trainer_utils import log, StepTimer, make_profiler
+from utils.metrics import MetricsAggregator, wandb
+from utils.checkpoint import CheckpointWriter, get_rng_state, set_rng_state, latest_checkpoint, periodic_checkpoints, new_run_directory
+from utils.controller import TrainingController
 
 class ConditionalBaseTrainer():
     def __init__(self, args):
         self.train_dataloader = get_dataloader(args, 'train')
         self.eval_dataloader = get_dataloader(args, 'eval')
+        # saved with the args, inference places the ODE latent state at the same origin as training
+        args.time_origin = float(self.train_dataloader.dataset.orig_ts[0])
         self.n_epochs = args.n_epochs
+        self.device = torch.device(args.device)
+        self.world_size, self.rank = args.world_size, args.rank
+        self.distributed = self.world_size > 1
+        self.is_main = self.rank == 0
 
         self.debug = args.debug
         self.dataset_type = args.dataset_type
         self.n_harmonics = args.n_harmonics
         NP = 'NP' if args.NP else 'nonNP'
 
-        filename = f'{datetime.now().date()}_{args.dataset_type}_{args.dataset_name}_{NP}_{args.lower_bound}_{args.upper_bound}_{args.encoder}_{args.encoder_blocks}_{args.encoder_hidden_dim}_decoder_{args.decoder}_{args.decoder_layers}'
+        # a resumed run keeps writing into the directory of the checkpoint it resumes from,
+        # a fresh run always gets a directory of its own, created by rank 0
+        self.resume_path = latest_checkpoint(args.resume) if args.resume is not None else None
+        if self.resume_path is not None:
+            self.path = os.path.dirname(os.path.abspath(self.resume_path))
+            filename = os.path.basename(self.path)
+        else:
+            filename = f'{datetime.now().date()}_{args.dataset_type}_{args.dataset_name}_{NP}_{args.lower_bound}_{args.upper_bound}_{args.encoder}_{args.encoder_blocks}_{args.encoder_hidden_dim}_decoder_{args.decoder}_{args.decoder_layers}'
+            self.path = args.path + filename
+            if self.is_main:
+                self.path = new_run_directory(self.path)
+                filename = os.path.basename(self.path)
+        if self.distributed:
+            # every rank uses the run directory of rank 0, even across midnight
+            path = [self.path]
+            dist.broadcast_object_list(path, src=0)
+            self.path = path[0]
+            filename = os.path.basename(self.path)
 
         args.filename = filename
-
-        self.path = args.path + filename
         self.file_path = self.path + '/' + filename
-        print(f'Model will be saved at {self.path}')
 
-        os.mkdir(self.path)
-        self.logger = log(path=self.path + '/', file=filename + '.logs')
+        # only rank 0 creates the run directory and logs, the other ranks only report warnings
+        if self.is_main:
+            print(f'Model will be saved at {self.path}')
+            self.logger = log(path=self.path + '/', file=filename + '.logs')
+        else:
+            self.logger = logging.getLogger(f'rank{self.rank}')
+            self.logger.setLevel(logging.WARNING)
+        if self.distributed:
+            dist.barrier()
 
 
 
@@ -39,110 +75,310 @@ class ConditionalNPTrainer(ConditionalBaseTrainer):
     def __init__(self, args):
         super(ConditionalNPTrainer, self).__init__(args)
 
-        self.model = ConditionalQueryFNP(args).cuda()
+        self.model = self.build_model(args)
+        self.bf16 = args.bf16
+        if args.compile != 'none' or self.bf16:
+            self.check_fast_path(args)
         self.optimizer = torch.optim.AdamW(self.model.parameters(), lr=args.lr)
+        # training steps go through the DDP wrapper, evaluation and checkpoints use the module itself
+        self.train_model = DistributedDataParallel(self.model) if self.distributed else self.model
         self.alpha = 1
-        self.max_num = 0
+        self.args = args
+        self.grid_cpu, self.grid = None, None
+        self.eval_set = self.preload_eval_set() if args.fixed_eval else None
 
-        if not self.debug:
+        use_wandb = not self.debug and wandb is not None and self.is_main
+        if use_wandb:
             wandb.init(project='FourierDecoder', config=args)
-            self.logger.info(f'Number of parameters: {count_parameters(self.model)}')
-            self.logger.info(f'Wandb Project Name: {args.dataset_type+args.dataset_name}'
-
-        print(f'Number of parameters: {count_parameters(self.model)}')
+            self.logger.info(f'Wandb Project Name: {args.dataset_type+args.dataset_name}')
+        elif not self.debug:
+            self.logger.info('wandb is not installed, metrics are only written locally')
+        self.logger.info(f'Number of parameters: {count_parameters(self.model)}')
+
+        # without wandb the metrics always go to a local JSONL file, training metrics are those of rank 0
+        jsonl_path = self.file_path + '_metrics.jsonl' if (args.metrics_jsonl or not use_wandb) and self.is_main else None
+        self.metrics = MetricsAggregator(args.log_every, logger=self.logger if self.is_main else None, use_wandb=use_wandb, jsonl_path=jsonl_path)
+
+        if self.is_main:
+            print(f'Number of parameters: {count_parameters(self.model)}')
+
+        self.log_every = args.log_every
+        self.timer = StepTimer(['data', 'forward', 'backward', 'optimizer', 'logging'], window=args.log_every,
+                               sync=args.sync_timing and self.device.type == 'cuda')
+        self.profiler = make_profiler(args, self.path, self.device) if args.profile_active > 0 and self.is_main else None
+        self.profile_steps = args.profile_wait + args.profile_warmup + args.profile_active
+
+        self.save_every = args.save_every
+        self.checkpoints = CheckpointWriter(keep_last=args.keep_last, existing=periodic_checkpoints(self.path))
+        self.start_epoch, self.best_mse = 0, float('inf')
+        self.controller = TrainingController(args, self.optimizer, len(self.train_dataloader), self.logger)
+        if self.resume_path is not None:
+            self.resume(self.resume_path)
 
     def train(self):
-        best_mse = float('inf')
-        for n_epoch in range(self.n_epochs):
+        if self.profiler is not None:
+            self.profiler.start()
+
+        for n_epoch in range(self.start_epoch, self.n_epochs):
             starttime = time.time()
+            self.set_epoch(n_epoch)
+            self.timer.start()
 
             for it, sample in enumerate(self.train_dataloader):
                 self.model.train()
                 self.optimizer.zero_grad(set_to_none=True)
-
-                samp_sin = sample['sin'].cuda()    # B, S, 1
-                label = sample['label'].squeeze(-1).cuda()     # B
-                orig_ts = sample['orig_ts'].cuda() # B, S
-                index = sample['index'].cuda()  # B, N
-
-                mse_loss, kl_loss = self.model(orig_ts, samp_sin, label, index)
-                loss = mse_loss + self.alpha * kl_loss
+                lr = self.controller.before_step()
+
+                samp_sin = sample['sin'].to(self.device, non_blocking=True)    # B, S, 1
+                label = sample['label'].squeeze(-1).to(self.device, non_blocking=True)     # B
+                orig_ts = self.to_device_grid(sample['orig_ts']) # S or B, S
+                index = sample['index'].to(self.device, non_blocking=True)  # B, N
+                obs_lengths = self.to_device_lengths(sample)  # B or None
+                self.timer.mark('data')
+
+                with autocast(self.device, self.bf16):
+                    mse_loss, kl_loss = self.train_model(orig_ts, samp_sin, label, index, obs_lengths)
+                    loss = mse_loss + self.alpha * kl_loss
                 # loss = mse_loss
-                loss.backward()
+                self.timer.mark('forward')
+                # an ensemble returns one loss per replica, their gradients are independent
+                loss.sum().backward()
+                self.timer.mark('backward')
                 self.optimizer.step()
-
-                if not self.debug:
-                    wandb.log({'train_loss': loss,
-                               'train_kl_loss': kl_loss,
-                               'train_mse_loss': mse_loss,
-                               'epoch': n_epoch,
-                               'alpha': self.alpha})
-                    self.logger.info(f'[Train Loss]: {loss:.4f}     [Train MSE]: {mse_loss:.4f}      [Train KL]: {kl_loss:.4f}')
-
-                else:
-                    print(f'[Train Loss]: {loss:.4f}      [Train MSE]: {mse_loss:.4f}    [Train KL]: {kl_loss:.4f}')
+                self.timer.mark('optimizer')
+
+                # reduced and written every log_every steps off the training thread
+                self.metrics.update({'train_loss': loss,
+                                     'train_kl_loss': kl_loss,
+                                     'train_mse_loss': mse_loss},
+                                    epoch=n_epoch,
+                                    alpha=self.alpha,
+                                    lr=lr)
+                self.timer.mark('logging')
+                self.end_step(samp_sin.size(0))
+                if self.controller.after_step():
+                    break
 
             endtime = time.time()
+            self.metrics.flush()
             if not self.debug:
                 self.logger.info(f'[Time] : {endtime-starttime}')
-            else:
+            elif self.is_main:
                 print(f'[Time] : {endtime-starttime}')
 
-            eval_loss, eval_mse, eval_kl = self.evaluation()
+            eval_loss = None
+            if self.controller.should_evaluate(n_epoch, self.n_epochs - 1):
+                eval_loss, eval_mse, eval_kl = self.evaluation()
+                self.metrics.log({'eval_loss': eval_loss,
+                                  'eval_mse': eval_mse,
+                                  'eval_kl': eval_kl,
+                                  'epoch': n_epoch,
+                                  'alpha': self.alpha})
+                self.controller.after_eval(n_epoch, eval_loss)
+            self.end_epoch(n_epoch, eval_loss)
+
+            if self.controller.stop_reason is not None:
+                self.logger.info(f'Training stopped at epoch {n_epoch}: {self.controller.stop_reason}')
+                break
+
+        self.checkpoints.close()
+        self.metrics.close()
+
+    def build_model(self, args):
+        return ConditionalQueryFNP(args).to(self.device)
+
+    def periodic_epoch(self, n_epoch):
+        # a stopped run always leaves a checkpoint to resume from
+        return n_epoch % self.save_every == 0 or n_epoch == self.n_epochs - 1 or self.controller.stop_reason is not None
+
+    def end_epoch(self, n_epoch, eval_loss):
+        # eval losses are all-reduced, so every rank takes the same checkpoint decisions, eval_loss is None between evaluations
+        if eval_loss is not None and self.best_mse > eval_loss:
+            self.best_mse = eval_loss
             if not self.debug:
-                wandb.log({'eval_loss': eval_loss,
-                           'eval_mse': eval_mse,
-                           'eval_kl': eval_kl,
-                           'epoch': n_epoch,
-                           'alpha': self.alpha})
-
-                self.logger.info(f'[Eval Loss]: {eval_loss:.4f}      [Eval MSE]: {eval_mse:.4f}   [Eval KL]: {eval_kl:.4f}')
-            else:
-                print(f'[Eval Loss]: {eval_loss:.4f}      [Eval MSE]: {eval_mse:.4f}      [Eval KL]: {eval_kl:.4f}')
-
-            if best_mse > eval_loss:
-                best_mse = eval_loss
-                if not self.debug:
-                    torch.save({'model_state_dict': self.model.state_dict(),
-                                'optimizer_state_dict': self.optimizer.state_dict(),
-                                'loss': best_mse}, self.file_path+'_best.pt')
-                    self.logger.info(f'Model parameter saved at {n_epoch}')
-
-            if n_epoch % 50 == 0:    # 50 epoch 마다 모델 저장하기
-                torch.save({'model_state_dict': self.model.state_dict(),
-                            'optimizer_state_dict': self.optimizer.state_dict(),
-                            'loss': eval_loss}, self.file_path + f'_{n_epoch + self.max_num}.pt')
+                self.save_checkpoint(n_epoch, self.best_mse, self.file_path+'_best.pt')
+                self.logger.info(f'Model parameter saved at {n_epoch}')
+
+        if self.periodic_epoch(n_epoch):
+            self.save_checkpoint(n_epoch, eval_loss, self.file_path + f'_{n_epoch}.pt', periodic=True)
+
+    def set_epoch(self, n_epoch):
+        # a DistributedSampler reshuffles from (seed, epoch), the sin sampler sits inside a BatchSampler,
+        # the streamed sin dataset generates its batches from the epoch
+        # and the length-bucketing sampler is the batch_sampler of the ECG loader
+        sampler = self.train_dataloader.sampler
+        for sampler in (sampler, getattr(sampler, 'sampler', None), self.train_dataloader.batch_sampler):
+            if isinstance(sampler, (DistributedSampler, LengthBucketBatchSampler)):
+                sampler.set_epoch(n_epoch)
+        if hasattr(self.train_dataloader.dataset, 'set_epoch'):
+            self.train_dataloader.dataset.set_epoch(n_epoch)
+
+    def save_checkpoint(self, n_epoch, loss, path, periodic=False):
+        # called on every rank since the RNG states are gathered, only rank 0 writes
+        state = self.checkpoint_state(n_epoch, loss)
+        if self.is_main:
+            self.checkpoints.save(state, path, periodic=periodic)
+
+    def checkpoint_state(self, n_epoch, loss):
+        # everything a resumed run needs to continue exactly where this epoch ended
+        rng_state = get_rng_state()
+        if self.distributed:
+            rng_states = [None] * self.world_size
+            dist.all_gather_object(rng_states, rng_state)
+            rng_state = rng_states
+        return {'model_state_dict': self.model.state_dict(),
+                'optimizer_state_dict': self.optimizer.state_dict(),
+                'loss': loss,
+                'epoch': n_epoch,
+                'best_loss': self.best_mse,
+                'rng_state': rng_state,
+                'controller_state': self.controller.state_dict(),
+                'args': vars(self.args)}
+
+    def resume(self, path):
+        ckpt = torch.load(path, map_location=self.device)
+        self.model.load_state_dict(ckpt['model_state_dict'])
+        self.optimizer.load_state_dict(ckpt['optimizer_state_dict'])
+        self.start_epoch = ckpt['epoch'] + 1
+        self.best_mse = ckpt['best_loss']
+        if 'controller_state' in ckpt:
+            self.controller.load_state_dict(ckpt['controller_state'])
+        rng_state = ckpt['rng_state']
+        # distributed runs store one RNG state per rank
+        if isinstance(rng_state, list):
+            rng_state = rng_state[self.rank % len(rng_state)]
+        set_rng_state(rng_state)
+        self.logger.info(f'Resumed from {path} at epoch {self.start_epoch}')
+
+    def end_step(self, n_samples):
+        self.timer.end_step(n_samples)
+        if self.timer.steps % self.log_every == 0:
+            self.logger.info(self.timer.summary())
+
+        if self.profiler is not None:
+            self.profiler.step()
+            if self.timer.steps >= self.profile_steps:
+                self.profiler.stop()
+                self.profiler = None
+                self.logger.info(f'Profiler trace saved at {self.path}/profiler')
+
+    def check_fast_path(self, args):
+        # compiled / scripted / bf16 runs have to match an eager fp32 copy of the same weights before training starts
+        reference = copy.deepcopy(self.model)
+        self.model.accelerate(args.compile)
+        error = fast_path_error(reference, self.model, next(iter(self.eval_dataloader)), self.device, self.bf16)
+        tolerance = args.fast_path_tol if args.fast_path_tol is not None else (5e-2 if self.bf16 else 1e-4)
+
+        self.logger.info(f'[Fast path] compile: {args.compile}  bf16: {self.bf16}  relative error: {error:.2e}  tolerance: {tolerance:.0e}')
+        assert error <= tolerance, f'fast path deviates from eager fp32 by {error:.2e} (tolerance {tolerance:.0e})'
+        self.model.train()
+
+    def to_device_grid(self, orig_ts):
+        # a shared (S) grid is moved to the device once and reused, which also keeps the Fourier basis cache warm
+        if orig_ts.dim() > 1:
+            return orig_ts.to(self.device, non_blocking=True)
+        if self.grid is None or not (orig_ts is self.grid_cpu or torch.equal(orig_ts, self.grid_cpu)):
+            self.grid_cpu, self.grid = orig_ts, orig_ts.to(self.device)
+        return self.grid
+
+    def to_device_lengths(self, sample):
+        # only batches of right-padded variable-length windows carry obs_lengths
+        if 'obs_lengths' not in sample:
+            return None
+        return sample['obs_lengths'].to(self.device, non_blocking=True)
+
+    def preload_eval_set(self):
+        # the eval observation indices are drawn once per run and cached next to the checkpoints,
+        # the whole eval set then lives on the device as contiguous tensors
+        sin, label, index, obs_lengths = [], [], [], []
+        orig_ts = None
+        for sample in get_dataloader(self.args, 'eval', shuffle=False, shard=False):
+            sin.append(sample['sin'])
+            label.append(sample['label'].squeeze(-1))
+            index.append(sample['index'])
+            obs_lengths.append(sample.get('obs_lengths', torch.full((sample['index'].size(0),), sample['index'].size(1))))
+            if orig_ts is None or sample['orig_ts'].size(-1) > orig_ts.size(-1):
+                orig_ts = sample['orig_ts']
+
+        # batches of variable-length windows are padded further to the longest of the eval set
+        S, N = orig_ts.size(-1), max(i.size(1) for i in index)
+        sin = [torch.nn.functional.pad(x, (0, 0, 0, S - x.size(1))) for x in sin]
+        index = torch.cat([torch.nn.functional.pad(i, (0, N - i.size(1))) for i in index])
+        obs_lengths = torch.cat(obs_lengths)
+
+        index_file = self.file_path + f'_eval_index_{index.size(1)}.npy'
+        if self.is_main and not os.path.isfile(index_file):
+            np.save(index_file, index.numpy())
+        if self.distributed:
+            dist.barrier()
+        index = torch.from_numpy(np.load(index_file))
+
+        assert orig_ts.dim() == 1, 'the fixed eval set needs a time grid shared by every sample'
+        # each rank keeps every world_size-th sample, the losses are all-reduced in fixed_evaluation
+        shard = slice(self.rank, None, self.world_size)
+        return {'sin': torch.cat(sin)[shard].to(self.device),
+                'label': torch.cat(label)[shard].to(self.device),
+                'orig_ts': orig_ts.to(self.device),
+                'index': index[shard].to(self.device),
+                'obs_lengths': obs_lengths[shard].to(self.device) if (obs_lengths < N).any() else None}
 
     def evaluation(self):
+        if self.eval_set is not None:
+            return self.fixed_evaluation()
+
         self.model.eval()
-        avg_eval_loss = 0.
-        avg_eval_mse = 0.
-        avg_kl = 0.
+        total, count = 0., 0
 
         with torch.no_grad():
             for it, sample in enumerate(self.eval_dataloader):
-                samp_sin = sample['sin'].cuda()
-                label = sample['label'].squeeze(-1).cuda()
-                orig_ts = sample['orig_ts'].cuda()
-                index = sample['index'].cuda()
-
-                mse_loss, kl_loss = self.model(orig_ts, samp_sin, label, index)
-                loss = mse_loss + self.alpha * kl_loss
+                samp_sin = sample['sin'].to(self.device, non_blocking=True)
+                label = sample['label'].squeeze(-1).to(self.device, non_blocking=True)
+                orig_ts = self.to_device_grid(sample['orig_ts'])
+                index = sample['index'].to(self.device, non_blocking=True)
+                obs_lengths = self.to_device_lengths(sample)
+
+                with autocast(self.device, self.bf16):
+                    mse_loss, kl_loss = self.model(orig_ts, samp_sin, label, index, obs_lengths)
+                    loss = mse_loss + self.alpha * kl_loss
                 # loss = mse_loss
-                avg_eval_loss += (loss.item() * samp_sin.size(0))
-                avg_eval_mse += (mse_loss.item() * samp_sin.size(0))
-                avg_kl += (kl_loss * samp_sin.size(0))
-
-            avg_eval_loss /= self.eval_dataloader.dataset.__len__()
-            avg_eval_mse /= self.eval_dataloader.dataset.__len__()
-            avg_kl /= self.eval_dataloader.dataset.__len__()
-
+                total = total + torch.stack((loss, mse_loss, kl_loss)).double() * samp_sin.size(0)
+                count += samp_sin.size(0)
+
+        # the eval shards are disjoint and unpadded, see get_dataloader
+        return self.reduce_eval(total, count)
+
+    def reduce_eval(self, total, count):
+        # total (3) or (3, K) for ensembles, summed (loss, mse, kl) of count samples, all-reduced over the ranks
+        count = torch.tensor(count, dtype=total.dtype, device=self.device)
+        if self.distributed:
+            dist.all_reduce(total)
+            dist.all_reduce(count)
+        avg_eval_loss, avg_eval_mse, avg_kl = (total / count).tolist()
         return avg_eval_loss, avg_eval_mse, avg_kl
 
+    def fixed_evaluation(self):
+        # the latent samples are drawn from a fixed seed as well, so eval losses are comparable across epochs
+        self.model.eval()
+        N = self.eval_set['sin'].size(0)
+        obs_lengths = self.eval_set['obs_lengths']
+        total = 0.
+
+        with torch.no_grad(), torch.random.fork_rng(devices=[self.device] if self.device.type == 'cuda' else []):
+            torch.manual_seed(0)
+            for start in range(0, N, self.args.eval_batch_size):
+                end = min(start + self.args.eval_batch_size, N)
+                with autocast(self.device, self.bf16):
+                    mse_loss, kl_loss = self.model(self.eval_set['orig_ts'], self.eval_set['sin'][start:end],
+                                                   self.eval_set['label'][start:end], self.eval_set['index'][start:end],
+                                                   None if obs_lengths is None else obs_lengths[start:end])
+                    loss = mse_loss + self.alpha * kl_loss
+                total = total + torch.stack((loss, mse_loss, kl_loss)).float() * (end - start)
+
+        return self.reduce_eval(total, N)
 
     def test(self):
         self.model.eval()
-        ckpt = torch.load(self.path)
+        ckpt = torch.load(self.path, map_location=self.device)
         self.model.load_state_dict(ckpt['model_state_dict'])
 
         avg_test_loss = 0.
@@ -150,9 +386,9 @@ class ConditionalNPTrainer(ConditionalBaseTrainer):
         avg_kl = 0.
         with torch.no_grad():
             for it, sample in enumerate(self.test_dataloder):
-                samp_sin = sample['sin'].cuda()
-                label = sample['label'].squeeze(-1).cuda()
-                orig_ts = sample['orig_ts'].cuda()
+                samp_sin = sample['sin'].to(self.device)
+                label = sample['label'].squeeze(-1).to(self.device)
+                orig_ts = sample['orig_ts'].to(self.device)
 
                 mse_loss, kl_loss = self.model(orig_ts, samp_sin, label, sampling=False)
                 loss = mse_loss + kl_loss
@@ -160,7 +396,39 @@ class ConditionalNPTrainer(ConditionalBaseTrainer):
                 avg_test_mse += (mse_loss.item() / len(self.test_dataloder))
                 avg_kl += (kl_loss.item() / len(self.test_dataloder))
 
-        if not self.debug:
+        if not self.debug and wandb is not None:
             wandb.log({'test_loss': avg_test_loss,
                        'test_mse': avg_test_mse,
                        'test_kl': avg_kl})
+
+
+class ConditionalEnsembleTrainer(ConditionalNPTrainer):
+    """
+    Trains args.ensemble replicas, seeded args.seed + k, in one vmapped forward pass (models/ensemble.py).
+    AdamW is elementwise, so one optimizer over the stacked parameters keeps independent per-replica state.
+    Metrics are logged per replica, every replica keeps its own best checkpoint in the ConditionalQueryFNP format,
+    the periodic checkpoints hold the whole ensemble for --resume.
+    """
+    def __init__(self, args):
+        super(ConditionalEnsembleTrainer, self).__init__(args)
+        if self.resume_path is None:
+            self.best_mse = [float('inf')] * args.ensemble
+
+    def build_model(self, args):
+        assert args.compile == 'none' and not args.bf16, 'the compile / bf16 fast paths are not supported for ensembles'
+        return ModelEnsemble(args, args.ensemble, seed=args.seed).to(self.device)
+
+    def end_epoch(self, n_epoch, eval_loss):
+        for k, loss in enumerate(eval_loss or []):
+            if self.best_mse[k] > loss:
+                self.best_mse[k] = loss
+                if not self.debug and self.is_main:
+                    self.checkpoints.save({'model_state_dict': self.model.replica_state_dict(k),
+                                           'loss': loss,
+                                           'epoch': n_epoch,
+                                           'replica': k,
+                                           'args': vars(self.args)}, self.file_path + f'_replica{k}_best.pt')
+                    self.logger.info(f'Replica {k} parameter saved at {n_epoch}')
+
+        if self.periodic_epoch(n_epoch):
+            self.save_checkpoint(n_epoch, eval_loss, self.file_path + f'_{n_epoch}.pt', periodic=True)
@@ -0,0 +1,117 @@
+import torch
+import numpy as np
+
+import glob
+import os
+import queue
+import random
+import re
+import threading
+
+
+def snapshot(state):
+    # detached CPU copies of every tensor, so training can keep updating the originals while the copy is written
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def get_rng_state():
+    # numpy's state is stored as plain lists so the checkpoint loads with torch.load(weights_only=True)
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {'python': random.getstate(),
+            'numpy': [name, keys.tolist(), pos, has_gauss, cached_gaussian],
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(state):
+    python_state = state['python']
+    random.setstate((python_state[0], tuple(python_state[1]), python_state[2]))
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'].cpu())
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+def periodic_checkpoints(run_dir):
+    # the periodic <run>_<epoch>.pt checkpoints of a run directory, oldest first
+    epochs = {}
+    for file in glob.glob(os.path.join(run_dir, '*.pt')):
+        match = re.search(r'_(\d+)\.pt$', file)
+        if match:
+            epochs[int(match.group(1))] = file
+    return [epochs[epoch] for epoch in sorted(epochs)]
+
+
+def new_run_directory(path):
+    # creates the directory of a fresh run, a name already taken by a non-empty directory gets a _<n> suffix
+    # so a new run never mixes its checkpoints, logs and eval indices with an earlier run's
+    candidate, n = path, 0
+    while True:
+        try:
+            os.makedirs(candidate)
+            return candidate
+        except FileExistsError:
+            if os.path.isdir(candidate) and not os.listdir(candidate):
+                return candidate
+        n += 1
+        candidate = f'{path}_{n}'
+
+
+def latest_checkpoint(path):
+    # path is a checkpoint file, or a run directory whose newest periodic checkpoint is returned
+    if os.path.isfile(path):
+        return path
+    checkpoints = periodic_checkpoints(path)
+    assert checkpoints, f'no periodic checkpoint found in {path}'
+    return checkpoints[-1]
+
+
+class CheckpointWriter():
+    """
+    Writes checkpoints on a background thread. State is snapshotted to CPU on the caller's thread,
+    each file is written to a temporary path and renamed into place, so a checkpoint is either complete or absent.
+    Only the newest keep_last periodic checkpoints are kept, the best checkpoint is always kept.
+    """
+    def __init__(self, keep_last=3, existing=()):
+        self.keep_last = keep_last
+        self.periodic = list(existing)  # oldest first
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def save(self, state, path, periodic=False):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((snapshot(state), path, periodic))
+
+    def write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            state, path, periodic = item
+            try:
+                torch.save(state, path + '.tmp')
+                os.replace(path + '.tmp', path)
+                if periodic:
+                    if path in self.periodic:
+                        self.periodic.remove(path)
+                    self.periodic.append(path)
+                    while len(self.periodic) > self.keep_last:
+                        os.remove(self.periodic.pop(0))
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
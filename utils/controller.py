@@ -0,0 +1,123 @@
+import torch
+import torch.distributed as dist
+
+import math
+import time
+
+from utils.model_utils import EarlyStopping
+
+
+class TrainingController():
+    """
+    Decides around the training loop what each step's learning rate is, when to evaluate and when to stop:
+    linear warmup followed by a constant, cosine or plateau-reduced learning rate, early stopping on the eval loss,
+    a step and a wall-clock budget, and an eval interval that halves from eval_every down to 1 once progress slows.
+    With the defaults it keeps the constant learning rate and evaluates after every epoch.
+    """
+    def __init__(self, args, optimizer, steps_per_epoch, logger):
+        self.optimizer = optimizer
+        self.base_lrs = [group['lr'] for group in optimizer.param_groups]
+        self.logger = logger
+        self.distributed = dist.is_available() and dist.is_initialized()
+
+        self.schedule = args.lr_schedule
+        self.warmup_steps = args.warmup_steps
+        self.min_lr_ratio = args.min_lr_ratio
+        self.plateau_patience, self.plateau_factor = args.plateau_patience, args.plateau_factor
+        self.min_delta = args.min_delta
+
+        self.max_steps = args.max_steps
+        self.time_budget = args.time_budget * 60 if args.time_budget is not None else None
+        self.total_steps = args.max_steps or args.n_epochs * steps_per_epoch
+        # the wall clock is compared, and agreed on across ranks, every check_every steps
+        self.check_every = args.log_every
+
+        self.eval_interval = args.eval_every
+        self.eval_slowdown = args.eval_slowdown
+        self.early_stopping = EarlyStopping(patience=args.patience, delta=args.min_delta, trace_func=logger.info) if args.patience else None
+
+        self.step = 0
+        self.elapsed, self.clock = 0., time.time()
+        self.plateau_scale, self.plateau_best, self.plateau_count = 1., float('inf'), 0
+        self.last_eval_epoch, self.last_eval_loss = -1, None
+        self.stop_reason = None
+
+    def lr_factor(self):
+        factor = min(1., (self.step + 1) / self.warmup_steps) if self.warmup_steps else 1.
+        if self.schedule == 'cosine':
+            progress = min(max((self.step - self.warmup_steps) / max(self.total_steps - self.warmup_steps, 1), 0.), 1.)
+            factor *= self.min_lr_ratio + (1 - self.min_lr_ratio) * 0.5 * (1 + math.cos(math.pi * progress))
+        elif self.schedule == 'plateau':
+            factor *= self.plateau_scale
+        return factor
+
+    def before_step(self):
+        # sets and returns the learning rate of the coming optimizer step
+        factor = self.lr_factor()
+        for group, base_lr in zip(self.optimizer.param_groups, self.base_lrs):
+            group['lr'] = base_lr * factor
+        return self.base_lrs[0] * factor
+
+    def after_step(self):
+        # returns True once a budget is exhausted
+        self.step += 1
+        if self.max_steps is not None and self.step >= self.max_steps:
+            self.stop_reason = f'step budget of {self.max_steps} steps'
+        elif self.time_budget is not None and self.step % self.check_every == 0:
+            exhausted = torch.tensor(float(self.elapsed_time() >= self.time_budget))
+            if self.distributed:
+                dist.all_reduce(exhausted, op=dist.ReduceOp.MAX)
+            if exhausted.item():
+                self.stop_reason = f'time budget of {self.time_budget / 60:g} minutes'
+        return self.stop_reason is not None
+
+    def should_evaluate(self, n_epoch, last_epoch):
+        return self.stop_reason is not None or n_epoch == last_epoch or n_epoch - self.last_eval_epoch >= self.eval_interval
+
+    def after_eval(self, n_epoch, eval_loss):
+        # eval_loss is all-reduced, so every rank reaches the same decisions, ensembles are controlled on their mean
+        if isinstance(eval_loss, list):
+            eval_loss = sum(eval_loss) / len(eval_loss)
+
+        if self.last_eval_loss is not None and self.eval_interval > 1:
+            progress = (self.last_eval_loss - eval_loss) / max(abs(self.last_eval_loss), 1e-12)
+            if progress < self.eval_slowdown:
+                self.eval_interval = max(1, self.eval_interval // 2)
+                self.logger.info(f'Eval progress {progress:.2%} per eval, evaluating every {self.eval_interval} epochs')
+        self.last_eval_epoch, self.last_eval_loss = n_epoch, eval_loss
+
+        if self.schedule == 'plateau':
+            if eval_loss < self.plateau_best - self.min_delta:
+                self.plateau_best, self.plateau_count = eval_loss, 0
+            else:
+                self.plateau_count += 1
+                if self.plateau_count >= self.plateau_patience:
+                    self.plateau_scale *= self.plateau_factor
+                    self.plateau_count = 0
+                    self.logger.info(f'Eval loss plateaued, learning rate scaled to {self.plateau_scale:g}x')
+
+        if self.early_stopping is not None:
+            self.early_stopping(eval_loss)
+            if self.early_stopping.early_stop:
+                self.stop_reason = f'no eval improvement in {self.early_stopping.patience} evaluations'
+
+    def elapsed_time(self):
+        return self.elapsed + time.time() - self.clock
+
+    def state_dict(self):
+        # the stop reason is not kept, a resumed run with a larger budget continues
+        state = {'step': self.step,
+                 'elapsed': self.elapsed_time(),
+                 'plateau': [self.plateau_scale, self.plateau_best, self.plateau_count],
+                 'eval': [self.eval_interval, self.last_eval_epoch, self.last_eval_loss]}
+        if self.early_stopping is not None:
+            state['early_stopping'] = [self.early_stopping.counter, self.early_stopping.best_score, self.early_stopping.val_loss_min]
+        return state
+
+    def load_state_dict(self, state):
+        self.step = state['step']
+        self.elapsed, self.clock = state['elapsed'], time.time()
+        self.plateau_scale, self.plateau_best, self.plateau_count = state['plateau']
+        self.eval_interval, self.last_eval_epoch, self.last_eval_loss = state['eval']
+        if self.early_stopping is not None and 'early_stopping' in state:
+            self.early_stopping.counter, self.early_stopping.best_score, self.early_stopping.val_loss_min = state['early_stopping']
@@ -0,0 +1,87 @@
+import torch
+
+import json
+import queue
+import threading
+
+try:
+    import wandb
+except ImportError:
+    wandb = None
+
+
+class MetricsAggregator():
+    """
+    Accumulates per-step metrics on the device and only reduces them every `every` steps, with a single sync.
+    The reduced means are handed to a background thread that writes them to wandb, the logger and / or a JSONL file,
+    so the training loop never blocks on a device sync or on I/O.
+    """
+    def __init__(self, every, logger=None, use_wandb=False, jsonl_path=None):
+        self.every = every
+        self.logger = logger
+        self.use_wandb = use_wandb and wandb is not None
+        self.jsonl = open(jsonl_path, 'a') if jsonl_path is not None else None
+
+        self.names, self.sums, self.count = None, None, 0
+        self.extra = {}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def update(self, metrics, **extra):
+        # metrics {name: scalar or (K) tensor}, extra python values logged with the next flush (e.g. epoch)
+        values = torch.stack([value.detach().float() for value in metrics.values()])
+        if self.sums is None:
+            self.names, self.sums = list(metrics.keys()), values
+        else:
+            self.sums += values
+        self.count += 1
+        self.extra = extra
+
+        if self.count >= self.every:
+            self.flush()
+
+    def flush(self):
+        if self.count == 0:
+            return
+        means = (self.sums / self.count).tolist()
+        record = dict(zip(self.names, means))
+        record.update(self.extra)
+        self.queue.put(self.expand(record))
+        self.names, self.sums, self.count = None, None, 0
+
+    def log(self, record):
+        # already reduced metrics, e.g. once per evaluation
+        self.queue.put(self.expand({name: value.tolist() if torch.is_tensor(value) else value for name, value in record.items()}))
+
+    @staticmethod
+    def expand(record):
+        # per-replica values of an ensemble are logged as name_0 ... name_{K-1}
+        expanded = {}
+        for name, value in record.items():
+            if isinstance(value, list):
+                expanded.update({f'{name}_{k}': v for k, v in enumerate(value)})
+            else:
+                expanded[name] = value
+        return expanded
+
+    def write(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if self.use_wandb:
+                wandb.log(record)
+            if self.logger is not None:
+                self.logger.info('  '.join(f'[{name}]: {value:.4f}' if isinstance(value, float) else f'[{name}]: {value}'
+                                           for name, value in record.items()))
+            if self.jsonl is not None:
+                self.jsonl.write(json.dumps(record) + '\n')
+                self.jsonl.flush()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.jsonl is not None:
+            self.jsonl.close()
@@ -1,13 +1,35 @@
 import torch
 import numpy as np
 import matplotlib.pyplot as plt
-import wandb
+
+from datasets.cond_dataset import observations
 
 
 def count_parameters(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
 
 
+def autocast(device, enabled):
+    # bf16 autocast on CPU or GPU, a no-op context when disabled
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=enabled)
+
+
+def fast_path_error(reference, model, sample, device, bf16=False):
+    # max abs difference between the decoded trajectories of an eager fp32 reference and a compiled / scripted / bf16 model,
+    # relative to the largest reference output, both decode from the posterior mean so the comparison is deterministic
+    obs_t, obs_x, label, obs_lengths, orig_ts = observations(sample, device)
+    samp_sin, index = sample['sin'].to(device), sample['index'].to(device)
+
+    outputs = []
+    with torch.no_grad():
+        for m, enabled in ((reference, False), (model, bf16)):
+            m.eval()
+            with autocast(device, enabled):
+                z, _ = m.encode(obs_t, obs_x, label, obs_lengths=obs_lengths)
+                outputs.append(m.decode(orig_ts, z, samp_sin, index).float())
+    return ((outputs[1] - outputs[0]).abs().max() / outputs[0].abs().max().clamp_min(1e-6)).item()
+
+
 class EarlyStopping:
     """Early stops the training if validation loss doesn't improve after a given patience."""
     def __init__(self, patience=7, verbose=False, delta=0, trace_func=print):
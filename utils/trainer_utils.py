@@ -1,5 +1,9 @@
+import torch
+
 import logging
 import os
+import time
+from collections import deque
 
 
 def log(path, file):
@@ -27,3 +31,113 @@ def log(path, file):
     logger.addHandler(handler)
 
     return logger
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def setup_distributed(args):
+    # torchrun sets WORLD_SIZE / RANK / LOCAL_RANK / LOCAL_WORLD_SIZE, a plain launch stays single-process
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.rank = int(os.environ.get('RANK', 0))
+    args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    args.local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    if args.world_size > 1:
+        torch.distributed.init_process_group(backend=args.dist_backend)
+
+
+def setup_device(args):
+    # resolves args.device and configures CPU threading, must run before any torch work
+    if args.device == 'auto':
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    local_rank, local_world_size = getattr(args, 'local_rank', 0), getattr(args, 'local_world_size', 1)
+    if args.device == 'cuda' and local_world_size > 1:
+        args.device = f'cuda:{local_rank}'
+    device = torch.device(args.device)
+    if device.type == 'cuda' and device.index is not None:
+        torch.cuda.set_device(device)
+
+    if args.num_interop_threads is not None:
+        torch.set_num_interop_threads(args.num_interop_threads)
+
+    cores = available_cores()
+    if device.type == 'cpu' and local_world_size > 1 and len(cores) >= local_world_size:
+        # every process on a node gets its own contiguous block of cores
+        chunk = len(cores) // local_world_size
+        cores = cores[local_rank*chunk:(local_rank+1)*chunk]
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+    args.worker_cores = None
+    if args.pin_workers and args.num_workers and len(cores) > args.num_workers:
+        # one dedicated core per DataLoader worker, the rest stay with the main process
+        args.worker_cores = cores[-args.num_workers:]
+        cores = cores[:-args.num_workers]
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+
+    if device.type == 'cpu':
+        torch.set_num_threads(args.num_threads or len(cores))
+    elif args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    return device
+
+
+def pin_worker(worker_id, cores):
+    # DataLoader worker_init_fn, pins each worker to its own core
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [cores[worker_id % len(cores)]])
+    torch.set_num_threads(1)
+
+
+class StepTimer():
+    """Per-phase wall-clock durations of training steps with rolling summaries over the last `window` steps."""
+    def __init__(self, phases, window=100, sync=False):
+        self.phases = phases
+        self.durations = {phase: deque(maxlen=window) for phase in phases}
+        self.step_times = deque(maxlen=window)
+        self.samples = deque(maxlen=window)
+        self.current = {}
+        self.steps = 0
+        # CUDA kernels run asynchronously, sync makes every phase include its kernels at the cost of a device sync
+        self.sync = sync
+        self.start()
+
+    def start(self):
+        # restarts the clock, e.g. after evaluation, so the next data phase only covers loading
+        self.last = self.step_start = time.perf_counter()
+
+    def mark(self, phase):
+        if self.sync:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.current[phase] = self.current.get(phase, 0.) + now - self.last
+        self.last = now
+
+    def end_step(self, n_samples):
+        for phase in self.phases:
+            self.durations[phase].append(self.current.get(phase, 0.))
+        self.step_times.append(self.last - self.step_start)
+        self.samples.append(n_samples)
+        self.current = {}
+        self.step_start = self.last
+        self.steps += 1
+
+    def summary(self):
+        total = sum(self.step_times)
+        phases = '  '.join(f'{phase}: {1e3 * sum(self.durations[phase]) / len(self.durations[phase]):.2f}ms '
+                           f'({100 * sum(self.durations[phase]) / total:.0f}%)' for phase in self.phases)
+        return f'[Step {self.steps}] {phases}  [Samples/sec]: {sum(self.samples) / total:.1f}'
+
+
+def make_profiler(args, path, device):
+    # torch.profiler over a window of warmup + active steps, the trace is exported to <path>/profiler
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device.type == 'cuda':
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(activities=activities,
+                                  schedule=torch.profiler.schedule(wait=args.profile_wait, warmup=args.profile_warmup, active=args.profile_active, repeat=1),
+                                  on_trace_ready=torch.profiler.tensorboard_trace_handler(os.path.join(path, 'profiler')),
+                                  record_shapes=True, profile_memory=True)